@@ -0,0 +1,55 @@
+import click
+import cv2 as cv
+from masker import Masker
+from maskstream import MaskStream
+
+@click.command()
+@click.option('-i', 'inputfile', type=click.Path(exists=True,resolve_path=True), required=True,
+              help='Source video the mask stream was computed from.')
+@click.option('-m', 'maskfile', type=click.Path(exists=True,resolve_path=True), required=True,
+              help='Mask stream written by main.py --mask-stream.')
+@click.option('-o', 'outputfolder', type=click.Path(resolve_path=True), default=None, required=False,
+              help='Specify folder to save masked video.')
+@click.option('--refresh-codecs', 'refresh_codecs', is_flag=True, default=False,
+              help='Probes the input video codec again instead of using the cached result of a previous run.')
+
+# composites a mask stream onto its source video, producing the same video as main.py without --mask-stream
+def ApplyMasks(inputfile, maskfile, outputfolder, refresh_codecs):
+    video = Masker(inputfile)
+    masks = MaskStream(maskfile)
+
+    if masks.resolution != video.resolution:
+        print(f'ERROR: The mask stream is {masks.width}x{masks.height} but the video is {video.w}x{video.h}. Exiting...')
+        return
+    # the frame range and region of interest the masks were computed for
+    if masks.start or masks.stride > 1 or masks.roi:
+        end = masks.start+(len(masks)-1)*masks.stride+1 if masks.start or masks.stride > 1 else None
+        if not video.set_region(masks.roi, masks.fill, masks.start, end, masks.stride):
+            return
+    if len(masks) != video.length:
+        print(f'WARNING: The mask stream has {len(masks)} frames but the video has {video.length}.')
+
+    output, fourcc = video.resolve_output(outputfolder, refresh_codecs)
+    masked_video = video.wrap_writer(cv.VideoWriter(output, fourcc, video.fps, video.resolution))
+
+    print('Applying masks to video frames...')
+    nframe = 0
+    for mask in masks:
+        ret, frame = video.capture.read() # extract frame
+        if not ret:
+            break
+        nframe += 1
+        if masks.roi:
+            x, y, w, h = masks.roi
+            mask = mask[y:y+h, x:x+w]
+        masked_video.write(cv.bitwise_and(frame, frame, mask=mask)) # mask frame
+        video.print_progress(nframe)
+
+    masked_video.release()
+    masks.close()
+    video.report_export(nframe, output)
+    video.capture.release()
+
+if __name__ == "__main__":
+
+    ApplyMasks()
@@ -0,0 +1,158 @@
+import contextlib
+import glob
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import click
+import cv2 as cv
+from masker import Masker
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov', '.m4v', '.mpg', '.mpeg', '.wmv')
+
+
+# returns the (video, hsv json or None) entries of a directory, glob pattern or JSON manifest.
+# A manifest is a list of video paths or of {"input": ..., "hsv": ...} objects, with paths
+# relative to the manifest directory.
+def collect_videos(source):
+    if os.path.isfile(source) and source.lower().endswith('.json'):
+        manifest_dir = os.path.dirname(os.path.abspath(source))
+        with open(source) as manifest_json:
+            manifest = json.load(manifest_json)
+        entries = []
+        for entry in manifest:
+            if isinstance(entry, str):
+                entry = {'input': entry}
+            hsv = entry.get('hsv')
+            entries.append((os.path.join(manifest_dir, entry['input']),
+                            os.path.join(manifest_dir, hsv) if hsv else None))
+        return entries
+
+    if os.path.isdir(source):
+        paths = [os.path.join(source, f) for f in sorted(os.listdir(source))]
+    else:
+        paths = sorted(glob.glob(source, recursive=True))
+    return [(os.path.abspath(p), None) for p in paths
+            if os.path.isfile(p) and p.lower().endswith(VIDEO_EXTENSIONS)]
+
+
+# HSV filter of a video: the manifest entry, a '<video name>.json' file next to the video or the shared filter
+def resolve_hsv(video_path, hsv, shared_hsv):
+    if hsv:
+        return hsv
+    sidecar = os.path.splitext(video_path)[0]+'.json'
+    if os.path.isfile(sidecar):
+        return sidecar
+    return shared_hsv
+
+
+# an output is up to date when it is newer than its inputs and has every frame of the video. An
+# interrupted or failed export leaves a newer but partial (or unreadable) output, which is redone.
+def is_up_to_date(output, inputs, frames):
+    if not os.path.exists(output):
+        return False
+    if not all(os.path.getmtime(output) >= os.path.getmtime(i) for i in inputs):
+        return False
+    capture = cv.VideoCapture(output)
+    nframe = int(capture.get(cv.CAP_PROP_FRAME_COUNT)) if capture.isOpened() else 0
+    capture.release()
+    return nframe == frames
+
+
+# worker process: masks one video and returns its summary
+def run_job(job, export_options):
+    summary = {'input': job['input'], 'hsv': job['hsv'], 'output': job['output'], 'frames': 0,
+               'expected_frames': job['frames'], 'wall_time': 0.0, 'fps': 0.0}
+    log = io.StringIO()
+    start = time.perf_counter()
+    try:
+        # messages of the export are kept for the summary instead of interleaving on the console
+        with contextlib.redirect_stdout(log):
+            video = Masker(job['input'])
+            output, nframe = video.mask_and_export(job['outputfolder'], job['hsv'], progress=False, **export_options)
+        summary['output'] = output
+        summary['frames'] = nframe
+        summary['status'] = 'done' if nframe == job['frames'] else 'incomplete'
+    except (Exception, SystemExit) as e:
+        # HSVfilter.import_from_file exits on invalid parameters
+        summary['status'] = 'failed'
+        summary['error'] = repr(e)
+    summary['wall_time'] = round(time.perf_counter()-start, 3)
+    summary['fps'] = round(summary['frames']/summary['wall_time'], 2) if summary['wall_time'] else 0.0
+    if summary['status'] != 'done':
+        summary['log'] = log.getvalue().replace('\r', '\n').strip().splitlines()[-5:]
+    return summary
+
+
+@click.command()
+@click.option('-i', 'source', type=str, required=True,
+              help='Directory of videos, glob pattern (e.g. "videos/**/*.mp4") or JSON manifest listing video paths or {"input": ..., "hsv": ...} entries.')
+@click.option('-o', 'outputfolder', type=click.Path(resolve_path=True), default=None, required=False,
+              help='Folder to save the masked videos. Defaults to the folder of each input video.')
+@click.option('-hsv', 'hsvparams', type=click.Path(resolve_path=True), default=None, required=False,
+              help='Shared JSON file with HSV filter parameters, used for videos without a manifest entry or a "<video name>.json" file next to them.')
+@click.option('--jobs', 'jobs', type=click.IntRange(min=1), default=os.cpu_count(),
+              help='Number of videos masked in parallel processes.')
+@click.option('--summary', 'summary_file', type=click.Path(resolve_path=True), default=None,
+              help='Path of the JSON summary of the batch. Defaults to batch_summary.json in the output folder (or the current folder).')
+@click.option('--force', 'force', is_flag=True, default=False,
+              help='Masks every video, also when its masked output is newer than the video and its HSV filter and has all of its frames.')
+@click.option('--workers', 'workers', type=click.IntRange(min=1), default=1,
+              help='Mask worker threads per video, see main.py --workers.')
+@click.option('--compiled/--no-compiled', 'compiled', default=False,
+              help='Thresholds frames through a cached lookup table, see main.py --compiled.')
+@click.option('--reuse-buffers/--no-reuse-buffers', 'reuse_buffers', default=False,
+              help='Reuses frame processing buffers, see main.py --reuse-buffers.')
+
+def BatchMasking(source, outputfolder, hsvparams, jobs, summary_file, force, workers, compiled, reuse_buffers):
+    export_options = {'workers': workers, 'compiled': compiled, 'reuse_buffers': reuse_buffers}
+
+    entries = collect_videos(source)
+    if not entries:
+        print(f'ERROR: No videos found in {source}. Exiting...')
+        return
+
+    queued, summaries = [], []
+    for video_path, hsv in entries:
+        hsv = resolve_hsv(video_path, hsv, hsvparams)
+        video = Masker(video_path)
+        job = {'input': video_path, 'hsv': hsv, 'outputfolder': outputfolder, 'frames': video.length,
+               'size': video.length*video.w*video.h}
+        job['output'], _ = video.resolve_output(outputfolder)
+        video.capture.release()
+
+        if video.length <= 0:
+            summaries.append({'input': video_path, 'hsv': hsv, 'output': job['output'], 'status': 'failed',
+                              'error': 'The video cannot be read.'})
+        elif not hsv:
+            summaries.append({'input': video_path, 'hsv': None, 'output': job['output'], 'status': 'failed',
+                              'error': 'No HSV filter parameters for this video.'})
+        elif not force and is_up_to_date(job['output'], [video_path, hsv], video.length):
+            summaries.append({'input': video_path, 'hsv': hsv, 'output': job['output'], 'status': 'up to date'})
+        else:
+            queued.append(job)
+
+    # largest jobs first, so a long video does not start last and extend the total time
+    queued.sort(key=lambda job: job['size'], reverse=True)
+    print(f'Masking {len(queued)} videos ({len(entries)-len(queued)} skipped) with {jobs} parallel jobs...')
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_job, job, export_options) for job in queued]
+        for n, future in enumerate(as_completed(futures), 1):
+            summary = future.result()
+            summaries.append(summary)
+            print(f'[{n}/{len(queued)}] {os.path.basename(summary["input"])}: {summary["status"]}, '
+                  f'{summary["frames"]} frames in {summary["wall_time"]}s ({summary["fps"]} fps)')
+
+    batch = {'source': source, 'wall_time': round(time.perf_counter()-start, 3), 'jobs': summaries}
+    if not summary_file:
+        summary_file = os.path.join(outputfolder if outputfolder else os.getcwd(), 'batch_summary.json')
+    with open(summary_file, 'w') as outfile:
+        json.dump(batch, outfile, indent=2)
+    print(f'Batch summary saved in the following directory:\n {summary_file}')
+
+if __name__ == "__main__":
+
+    BatchMasking()
@@ -0,0 +1,255 @@
+import contextlib
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import click
+import numpy as np
+import cv2 as cv
+from masker import Masker
+from hsvfilter import HSVfilter
+from compiledfilter import CompiledHSVfilter
+from cachedir import get_cache_dir
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080), '4k': (3840, 2160), '8k': (7680, 4320)}
+
+# filter settings of the benchmark matrix: blur, CLAHE, object/hole removal and close kernel
+MATRIX = {
+    'blur': [0, 5],
+    'clahe': [0, 1],
+    'area': [(0, 0), (20000, 5000)],
+    'close': [0, 5],
+}
+QUICK_MATRIX = [
+    {'blur': 0, 'clahe': 0, 'area': (0, 0), 'close': 0},
+    {'blur': 5, 'clahe': 0, 'area': (20000, 5000), 'close': 5},
+    {'blur': 5, 'clahe': 1, 'area': (20000, 5000), 'close': 5},
+]
+
+
+# low-frequency noise in [0, 1], the sum of random grids of 'cells' columns upsampled to the
+# frame size, so that the scene looks the same at every resolution
+def smooth_noise(rng, w, h, cells=(4, 16, 64)):
+    field = np.zeros((h, w), np.float32)
+    for i, columns in enumerate(cells):
+        grid = rng.rand(max(2, columns*h//w), columns).astype(np.float32)
+        field += cv.resize(grid, (w, h), interpolation=cv.INTER_CUBIC) / 2**i
+    field -= field.min()
+    return field/field.max()
+
+
+# writes a deterministic satellite-like video: a land/sea coastline with textured land, a sea
+# gradient, speckle noise and a slow pan. Uses a lossless codec when one is available.
+def generate_video(path, resolution, nframes, fourcc, seed=0):
+    w, h = resolution
+    rng = np.random.RandomState(seed)
+    pan = nframes*2
+    elevation = smooth_noise(rng, w+pan, h)
+    texture = smooth_noise(rng, w+pan, h, cells=(64, 256))
+    land = elevation > 0.45
+
+    scene = np.empty((h, w+pan, 3), np.uint8)
+    sea_depth = np.clip(0.45-elevation, 0, 0.45)/0.45
+    scene[...,0] = (150+100*sea_depth).astype(np.uint8) # B
+    scene[...,1] = (110-50*sea_depth).astype(np.uint8)  # G
+    scene[...,2] = (40-30*sea_depth).astype(np.uint8)   # R
+    scene[land,0] = (30+40*texture[land]).astype(np.uint8)
+    scene[land,1] = (90+80*texture[land]).astype(np.uint8)
+    scene[land,2] = (60+90*texture[land]).astype(np.uint8)
+
+    writer = cv.VideoWriter(path, fourcc, 25, (w, h))
+    for i in range(nframes):
+        frame = scene[:, 2*i:2*i+w].copy()
+        # sensor noise and bright/dark speckle (clouds, boats, dead pixels)
+        frame = cv.add(frame, rng.randint(0, 12, frame.shape).astype(np.uint8))
+        speckle = rng.rand(h, w)
+        frame[speckle < 0.002] = 0
+        frame[speckle > 0.998] = 255
+        writer.write(frame)
+    writer.release()
+
+
+def get_video(video_dir, name, nframes):
+    # FFV1 keeps the synthetic frames exact, MJPG is the fallback available in every OpenCV build
+    for codec, extension in (('FFV1', 'mkv'), ('MJPG', 'avi')):
+        path = os.path.join(video_dir, f'synthetic_{name}_{nframes}.{extension}')
+        if os.path.exists(path):
+            return path
+        writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*codec), 25, (64, 64))
+        opened = writer.isOpened()
+        writer.release()
+        os.remove(path) if os.path.exists(path) else None
+        if opened:
+            print(f'Generating synthetic {name} video ({nframes} frames)...')
+            generate_video(path, RESOLUTIONS[name], nframes, cv.VideoWriter_fourcc(*codec))
+            return path
+    raise RuntimeError('No codec available to write the synthetic videos.')
+
+
+def get_filter(setting):
+    hsv_filter = HSVfilter(hMin=90, sMin=100, vMin=0, hMax=130, sMax=255, vMax=255)
+    hsv_filter.blur = setting['blur']
+    hsv_filter.clahe = setting['clahe']
+    hsv_filter.object, hsv_filter.hole = setting['area']
+    hsv_filter.close = setting['close']
+    return hsv_filter
+
+
+def get_case_name(resolution, setting):
+    return f"{resolution}/blur{setting['blur']}-clahe{setting['clahe']}-area{setting['area'][0]}-close{setting['close']}"
+
+
+# peak resident set size of this process in MiB, None where it cannot be measured
+def get_peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB on Linux
+    return round(peak/1024/1024 if sys.platform == 'darwin' else peak/1024, 1)
+
+
+# runs one benchmark case in a fresh process, so that the peak RSS belongs to this case only
+def run_case(video_path, setting, export_options):
+    hsv_filter = get_filter(setting)
+    video = Masker(video_path)
+    # the masks are computed as in the export, with the compiled filter and the reused buffers
+    if export_options.get('compiled'):
+        video.compiled_filter = CompiledHSVfilter(video, hsv_filter)
+    context = video.create_context(hsv_filter, reuse_buffers=export_options.get('reuse_buffers', False))
+
+    # create_mask latency per frame, frames are decoded outside of the timed section
+    latencies = []
+    while True:
+        if context:
+            ret, frame = context.read(video.capture)
+        else:
+            ret, frame = video.capture.read()
+        if not ret:
+            break
+        start = time.perf_counter()
+        if context:
+            context.create_mask(frame)
+        else:
+            video.create_mask(frame, hsv_filter)
+        latencies.append(time.perf_counter()-start)
+    if hasattr(context, 'close'):
+        context.close()
+    video.capture.release()
+
+    # end-to-end export, including decoding and encoding
+    with tempfile.TemporaryDirectory() as temp_dir:
+        hsvparams = os.path.join(temp_dir, 'hsv.json')
+        with open(hsvparams, 'w') as outfile:
+            json.dump(hsv_filter.to_dict(), outfile)
+        video = Masker(video_path)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            _, nframe = video.mask_and_export(temp_dir, hsvparams, progress=False, **export_options)
+            export_time = time.perf_counter()-start
+
+    latencies_ms = np.array(latencies)*1000
+    return {
+        'frames': len(latencies),
+        'create_mask_fps': round(len(latencies)/sum(latencies), 2),
+        'latency_ms_p50': round(float(np.percentile(latencies_ms, 50)), 2),
+        'latency_ms_p95': round(float(np.percentile(latencies_ms, 95)), 2),
+        'latency_ms_p99': round(float(np.percentile(latencies_ms, 99)), 2),
+        'export_fps': round(nframe/export_time, 2),
+        'peak_rss_mib': get_peak_rss(),
+    }
+
+
+# returns the regressions of 'results' against 'baseline', relative tolerance 'tolerance'
+def compare_to_baseline(results, baseline, tolerance):
+    regressions = []
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        base = baseline[case]
+        for metric in ('create_mask_fps', 'export_fps'):
+            if result[metric] < base[metric]*(1-tolerance):
+                regressions.append(f'{case}: {metric} {result[metric]} < baseline {base[metric]}')
+        for metric in ('latency_ms_p95', 'peak_rss_mib'):
+            if result[metric] is not None and base.get(metric) is not None and result[metric] > base[metric]*(1+tolerance):
+                regressions.append(f'{case}: {metric} {result[metric]} > baseline {base[metric]}')
+    return regressions
+
+
+def print_table(results):
+    print(f'\n{"case":<48} {"mask fps":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"export fps":>11} {"peak MiB":>9}')
+    for case, r in results.items():
+        print(f'{case:<48} {r["create_mask_fps"]:>9} {r["latency_ms_p50"]:>8} {r["latency_ms_p95"]:>8} '
+              f'{r["latency_ms_p99"]:>8} {r["export_fps"]:>11} {str(r["peak_rss_mib"]):>9}')
+
+
+@click.command()
+@click.option('--resolutions', 'resolutions', type=str, default='720p,1080p',
+              help='Comma-separated resolutions to benchmark: 720p, 1080p, 4k, 8k.')
+@click.option('--frames', 'nframes', type=click.IntRange(min=1), default=20,
+              help='Number of frames of every synthetic video.')
+@click.option('--quick', 'quick', is_flag=True, default=False,
+              help='Benchmarks 3 representative filter settings instead of the full 16-setting matrix.')
+@click.option('--video-dir', 'video_dir', type=click.Path(resolve_path=True), default=None,
+              help='Folder of the generated synthetic videos (kept between runs). Defaults to the user cache directory.')
+@click.option('-o', 'output', type=click.Path(resolve_path=True), default='benchmark_results.json',
+              help='JSON file to write the results to.')
+@click.option('--baseline', 'baseline_file', type=click.Path(exists=True, resolve_path=True), default=None,
+              help='Baseline results JSON. The run fails when a case is slower or uses more memory than the baseline beyond --tolerance.')
+@click.option('--tolerance', 'tolerance', type=click.FloatRange(min=0), default=0.1,
+              help='Relative tolerance of the baseline comparison.')
+@click.option('--workers', 'workers', type=click.IntRange(min=1), default=1,
+              help='Mask worker threads of the export, see main.py --workers.')
+@click.option('--compiled/--no-compiled', 'compiled', default=False,
+              help='Benchmarks the compiled lookup-table filter, see main.py --compiled.')
+@click.option('--reuse-buffers/--no-reuse-buffers', 'reuse_buffers', default=False,
+              help='Benchmarks the reused-buffer processing context, see main.py --reuse-buffers.')
+
+def Benchmark(resolutions, nframes, quick, video_dir, output, baseline_file, tolerance, workers, compiled, reuse_buffers):
+    export_options = {'workers': workers, 'compiled': compiled, 'reuse_buffers': reuse_buffers}
+    video_dir = video_dir if video_dir else get_cache_dir('benchmark')
+    os.makedirs(video_dir, exist_ok=True)
+
+    names = [r.strip().lower() for r in resolutions.split(',')]
+    for name in names:
+        if name not in RESOLUTIONS:
+            print(f'ERROR: Unknown resolution {name}. Choose from {", ".join(RESOLUTIONS)}. Exiting...')
+            quit()
+    settings = QUICK_MATRIX if quick else [dict(zip(MATRIX, values)) for values in itertools.product(*MATRIX.values())]
+
+    results = {}
+    for name in names:
+        video_path = get_video(video_dir, name, nframes)
+        for setting in settings:
+            case = get_case_name(name, setting)
+            print(f'Running {case}...')
+            # a new process per case, so the peak RSS is not inherited from previous cases
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results[case] = executor.submit(run_case, video_path, setting, export_options).result()
+
+    print_table(results)
+    with open(output, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+    print(f'\nBenchmark results saved in the following directory:\n {output}')
+
+    if baseline_file:
+        with open(baseline_file) as baseline_json:
+            baseline = json.load(baseline_json)
+        regressions = compare_to_baseline(results, baseline, tolerance)
+        if regressions:
+            print(f'\n{len(regressions)} regressions against the baseline:')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+        print('\nNo regressions against the baseline.')
+
+if __name__ == "__main__":
+
+    Benchmark()
@@ -0,0 +1,31 @@
+import contextlib
+import os
+import tempfile
+
+# returns (and creates) the per-user cache directory of the tool, optionally a subdirectory of it
+def get_cache_dir(subdir=None):
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+
+    cache_dir = os.path.join(base, 'hsvlandmasking')
+    if subdir:
+        cache_dir = os.path.join(cache_dir, subdir)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+# Opens a temporary file next to 'path' for writing and moves it to 'path' once the block finishes.
+# Readers, including concurrent jobs, never see a partial file, and an interrupted or failed write
+# keeps the previous file.
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    fd, temp_path = tempfile.mkstemp(suffix=os.path.splitext(path)[1], dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
@@ -1,25 +1,86 @@
 import cv2 as cv
 import os
+import json
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from cachedir import atomic_write, get_cache_dir
 
-def is_fourcc_available(codec):
+CODECS_TO_TEST = ["DIVX", "XVID", "MJPG", "X264", "WMV1", "WMV2", "FMP4",
+                  "mp4v", "avc1", "I420", "IYUV", "mpg1", "H264"]
+
+CACHE_FILE = 'codecs.json'
+
+# probe results depend on the OpenCV build (video backends and the codecs compiled into them)
+def get_build_key():
+    build_info = hashlib.sha1(cv.getBuildInformation().encode()).hexdigest()[:16]
+    return f'{cv.__version__}-{build_info}'
+
+def load_cache():
+    try:
+        with open(os.path.join(get_cache_dir(), CACHE_FILE)) as cache_json:
+            cache = json.load(cache_json)
+    except (FileNotFoundError, ValueError, OSError):
+        return {}
+    return cache.get(get_build_key(), {})
+
+def save_cache(results):
+    cache_dir = get_cache_dir()
+    cache_file = os.path.join(cache_dir, CACHE_FILE)
+    try:
+        with open(cache_file) as cache_json:
+            cache = json.load(cache_json)
+    except (FileNotFoundError, ValueError, OSError):
+        cache = {}
+    cache[get_build_key()] = {**cache.get(get_build_key(), {}), **results}
+
+    with atomic_write(cache_file) as outfile:
+        json.dump(cache, outfile)
+
+# converts an integer fourcc code (e.g. from CAP_PROP_FOURCC) to its four characters
+def fourcc_to_string(fourcc):
+    return ''.join(chr((int(fourcc) >> 8*i) & 0xFF) for i in range(4))
+
+def is_fourcc_available(codec, extension='.mkv'):
+    # every probe writes its own temporary file, so parallel probes and jobs never collide
+    fd, path = tempfile.mkstemp(suffix=extension)
+    os.close(fd)
     try:
         fourcc = cv.VideoWriter_fourcc(*codec)
-        temp_video = cv.VideoWriter('temp.mkv', fourcc, 30, (640, 480), isColor=True)
+        temp_video = cv.VideoWriter(path, fourcc, 30, (640, 480), isColor=True)
+        available = temp_video.isOpened()
         temp_video.release()
-        os.remove('temp.mkv')
-        return True
+        return available
     except:
         return False
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+# checks a single codec/container pair, using the cached result when there is one
+def is_codec_installed(codec, extension='.mkv', refresh=False):
+    if len(codec) != 4 or not codec.isprintable():
+        return False
+    key = f'{extension}:{codec}'
+    cache = {} if refresh else load_cache()
+    if key not in cache:
+        cache[key] = is_fourcc_available(codec, extension)
+        save_cache({key: cache[key]})
+    return cache[key]
 
-def get_installed_fourcc_codecs():
-    codecs_to_test = ["DIVX", "XVID", "MJPG", "X264", "WMV1", "WMV2", "FMP4",
-                      "mp4v", "avc1", "I420", "IYUV", "mpg1", "H264"]
-    available_codecs = []
-    for codec in codecs_to_test:
-        available_codecs.append((codec, is_fourcc_available(codec)))
-    installed_codecs = [i for i,x in available_codecs if x]
+def get_installed_fourcc_codecs(refresh=False, extension='.mkv'):
+    cache = {} if refresh else load_cache()
+    missing = [codec for codec in CODECS_TO_TEST if f'{extension}:{codec}' not in cache]
+    if missing:
+        # probe the codecs that are not cached yet concurrently
+        with ThreadPoolExecutor() as executor:
+            results = dict(zip(missing, executor.map(lambda codec: is_fourcc_available(codec, extension), missing)))
+        results = {f'{extension}:{codec}': available for codec, available in results.items()}
+        cache.update(results)
+        save_cache(results)
+    installed_codecs = [codec for codec in CODECS_TO_TEST if cache[f'{extension}:{codec}']]
     return installed_codecs
 
 # if __name__ == "__main__":
-#     codecs = get_installed_fourcc_codecs()
+#     codecs = get_installed_fourcc_codecs(refresh=True)
 #     print(codecs)
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import shutil
+import cv2 as cv
+from cachedir import atomic_write
+from segments import get_part_format, concatenate_videos
+
+# Checkpointed export. The masked video is written as a sequence of partial videos of
+# 'interval' frames in a checkpoint folder next to the output. After every finished part the
+# checkpoint file records the next frame to mask, the masked parts, the skipped frames and a hash
+# of the video, the HSV filter and the export options. An interrupted or failed export is resumed
+# from the last recorded frame, and the parts are joined into the output once the video is done.
+
+DEFAULT_CHECKPOINT_INTERVAL = 1000 # frames
+CHECKPOINT_FILE = 'checkpoint.json'
+
+
+# returns the checkpoint folder of 'output'
+def get_checkpoint_dir(output):
+    return os.path.join(os.path.dirname(output), '.'+os.path.basename(output)+'.checkpoint')
+
+
+# a checkpoint is only resumed by an export of the same video with the same filter and options
+def get_export_key(masker, hsv_filter, context_options, part_fourcc, extension):
+    stat = os.stat(masker.video_path)
+    parameters = [masker.video_path, stat.st_size, stat.st_mtime_ns, hsv_filter.to_dict(),
+                  context_options, masker.region, part_fourcc, extension]
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_checkpoint(checkpoint_dir):
+    try:
+        with open(os.path.join(checkpoint_dir, CHECKPOINT_FILE)) as checkpoint_json:
+            return json.load(checkpoint_json)
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+
+
+def save_checkpoint(checkpoint_dir, checkpoint):
+    with atomic_write(os.path.join(checkpoint_dir, CHECKPOINT_FILE)) as outfile:
+        json.dump(checkpoint, outfile)
+
+
+# masks the video of 'masker' into 'output' with checkpoints every 'interval' frames, continuing
+# from the checkpoint of a previous export with 'resume'. Returns the number of masked frames.
+# The checkpoint folder is removed once every frame is masked or skipped, otherwise it is kept for
+# the next --resume.
+def mask_checkpointed(masker, hsv_filter, output, fourcc, interval, resume=False, context=None,
+                      context_options=None, skip_corrupt=False, progress=True, allocations=None):
+    checkpoint_dir = get_checkpoint_dir(output)
+    part_fourcc, extension = get_part_format(masker, output, fourcc)
+    key = get_export_key(masker, hsv_filter, context_options, part_fourcc, extension)
+
+    checkpoint = load_checkpoint(checkpoint_dir) if resume else None
+    if resume and checkpoint is None:
+        print('No checkpoint found, starting from frame 0.')
+    elif checkpoint and checkpoint.get('key') != key:
+        print('WARNING: The checkpoint was written for another video, HSV filter or export options, starting from frame 0.')
+        checkpoint = None
+
+    if checkpoint:
+        print(f"Resuming from frame {checkpoint['frame']} ({len(checkpoint['parts'])} masked parts).")
+    else:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        os.makedirs(checkpoint_dir)
+        checkpoint = {'video': masker.video_path, 'key': key, 'frame': 0, 'masked': 0, 'parts': [], 'skipped': []}
+        save_checkpoint(checkpoint_dir, checkpoint)
+    masker.skipped_frames = tuple(checkpoint['skipped'])
+
+    start = checkpoint['frame']
+    if start:
+        masker.capture.set(cv.CAP_PROP_POS_FRAMES, start)
+        position = int(masker.capture.get(cv.CAP_PROP_POS_FRAMES))
+        if position != start:
+            print(f'WARNING: seeking to frame {start} landed on frame {position}.')
+
+    while checkpoint['frame'] < masker.length:
+        part = f"part_{len(checkpoint['parts']):05d}{extension}"
+        part_path = os.path.join(checkpoint_dir, part)
+        frames = min(interval, masker.length-checkpoint['frame'])
+        skipped = len(masker.skipped_frames)
+
+        masked_video = masker.wrap_writer(cv.VideoWriter(part_path, part_fourcc, masker.fps, masker.resolution))
+        try:
+            nframe = masker.mask_frames(hsv_filter, masked_video, max_frames=frames, progress=progress, context=context,
+                                        allocations=allocations, first_frame=checkpoint['frame'], skip_corrupt=skip_corrupt)
+        except KeyboardInterrupt:
+            # the unfinished part is discarded, the checkpoint still points to its first frame
+            masked_video.release()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            print(f"\nExport interrupted. Run again with --resume to continue from frame {checkpoint['frame']}.")
+            raise
+        masked_video.release()
+
+        skipped = len(masker.skipped_frames)-skipped
+        if nframe:
+            checkpoint['parts'].append(part)
+        elif os.path.exists(part_path):
+            os.remove(part_path)
+        checkpoint['frame'] += nframe+skipped
+        checkpoint['masked'] += nframe
+        checkpoint['skipped'] = list(masker.skipped_frames)
+        save_checkpoint(checkpoint_dir, checkpoint)
+
+        if nframe+skipped < frames:
+            # read error before the end of the video
+            break
+
+    parts = [os.path.join(checkpoint_dir, part) for part in checkpoint['parts']]
+    nframe = 0
+    if parts:
+        print('\nJoining masked parts...')
+        nframe = concatenate_videos(parts, output, fourcc, masker.fps, masker.resolution)
+        if nframe != checkpoint['masked']:
+            print(f"WARNING: joined video has {nframe} frames, parts contained {checkpoint['masked']} frames.")
+
+    if checkpoint['frame'] >= masker.length:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    else:
+        print(f"Checkpoint kept in {checkpoint_dir}. Run again with --resume (and --skip-corrupt-frames to skip unreadable frames) to continue from frame {checkpoint['frame']}.")
+    return nframe
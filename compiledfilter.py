@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import numpy as np
+import cv2 as cv
+from cachedir import atomic_write, get_cache_dir
+
+# HSVfilter parameters that decide the per-pixel HSV threshold of a frame
+LUT_PARAMETERS = ["hMin", "sMin", "vMin", "hMax", "sMax", "vMax", "sAdd", "sSub", "vAdd", "vSub", "ranges"]
+
+
+# "Compiled" HSV filter. The BGR->HSV conversion, the S/V adjustments and the HSV range
+# thresholds are a pure function of each pixel's BGR value, so they are evaluated once for
+# all 256^3 colours into a lookup table. A frame is then thresholded with a single gather,
+# no matter how many HSV ranges the filter has. Blur, CLAHE and the mask cleanup are not
+# per-pixel and still run as before.
+# The table is stored bit-packed (2 MB) in the cache directory, keyed by the filter
+# parameters and the OpenCV version, and unpacked to one byte per colour (16 MB) in memory.
+class CompiledHSVfilter:
+
+    def __init__(self, masker, hsv_filter, cache_dir=None):
+        self.hsv_filter = hsv_filter
+        self.cache_dir = cache_dir if cache_dir else get_cache_dir('lut')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.key = self.get_key(hsv_filter)
+        self.path = os.path.join(self.cache_dir, f'hsv_lut_{self.key}.npy')
+
+        self.table = self.load()
+        if self.table is None:
+            print('Compiling HSV filter lookup table...')
+            self.table = self.build(masker)
+            self.save()
+
+    @staticmethod
+    def get_key(hsv_filter):
+        hsv_parameters = hsv_filter.to_dict()
+        parameters = {p: hsv_parameters.get(p, []) for p in LUT_PARAMETERS}
+        parameters['opencv'] = cv.__version__
+        return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:16]
+
+    # True when the table computes the HSV threshold of 'hsv_filter', which may be a copy of the
+    # compiled filter with different preprocessing or cleanup parameters
+    def matches(self, hsv_filter):
+        return hsv_filter is self.hsv_filter or self.get_key(hsv_filter) == self.key
+
+    # thresholds every 24-bit BGR colour, laid out as a 4096x4096 image, with the regular HSV filter
+    def build(self, masker):
+        colours = np.arange(1 << 24, dtype=np.uint32)
+        bgr = np.empty((1 << 24, 3), np.uint8)
+        bgr[:,0] = colours >> 16
+        bgr[:,1] = (colours >> 8) & 255
+        bgr[:,2] = colours & 255
+        del colours
+
+        mask = masker.threshold_hsv(bgr.reshape(4096, 4096, 3), self.hsv_filter)
+        return mask.reshape(-1)
+
+    def load(self):
+        try:
+            packed = np.load(self.path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        if packed.shape != ((1 << 24)//8,):
+            return None
+        return np.unpackbits(packed)*np.uint8(255)
+
+    def save(self):
+        packed = np.packbits(self.table > 0)
+        with atomic_write(self.path, 'wb') as f:
+            np.save(f, packed)
+
+    # returns the HSV threshold mask of a BGR frame
+    def apply(self, frame):
+        index = frame[:,:,0].astype(np.uint32)
+        index <<= 8
+        index |= frame[:,:,1]
+        index <<= 8
+        index |= frame[:,:,2]
+        return np.take(self.table, index)
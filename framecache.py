@@ -0,0 +1,86 @@
+import hashlib
+import json
+import math
+import os
+import numpy as np
+import cv2 as cv
+from cachedir import atomic_write, get_cache_dir
+from exceptions import VideoReadError
+
+# Decoded-frame cache for GUI mode. Every 'step'-th frame of the video is decoded once, resized
+# to the preview size and stored as raw BGR frames in the cache directory, keyed by the video
+# file, the step and the preview size. Later sessions on the same video memory-map the cached
+# frames instead of decoding the video, and any cached frame can be shown directly, which makes
+# looping and scrubbing free of seeking and decoding.
+# By default the step keeps the cache under 'max_frames' frames and the preview is at most
+# 'preview_width' pixels wide.
+class FrameCache:
+
+    def __init__(self, masker, step=None, scale=None, max_frames=300, preview_width=1280, cache_dir=None):
+        self.video_path = os.path.abspath(masker.video_path)
+        self.step = step if step else max(1, math.ceil(masker.length/max_frames))
+        self.scale = scale if scale else min(1.0, preview_width/masker.w)
+        self.size = (max(1, round(masker.w*self.scale)), max(1, round(masker.h*self.scale)))
+        self.cache_dir = cache_dir if cache_dir else get_cache_dir('frames')
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        key = self.get_key()
+        self.path = os.path.join(self.cache_dir, f'frames_{key}.bin')
+        self.meta_path = os.path.join(self.cache_dir, f'frames_{key}.json')
+
+        if not self.load():
+            self.build(masker.capture, masker.length)
+            if not self.load():
+                raise VideoReadError
+
+    # the cache is rebuilt when the video file is replaced or modified
+    def get_key(self):
+        stat = os.stat(self.video_path)
+        parameters = [self.video_path, stat.st_size, stat.st_mtime_ns, self.step, self.size]
+        return hashlib.sha1(json.dumps(parameters).encode()).hexdigest()[:16]
+
+    def load(self):
+        try:
+            with open(self.meta_path) as meta_json:
+                meta = json.load(meta_json)
+            w, h = self.size
+            self.frames = np.memmap(self.path, np.uint8, mode='r', shape=(meta['frames'], h, w, 3))
+        except (FileNotFoundError, ValueError, OSError, KeyError):
+            return False
+        self.indices = meta['indices'] # source frame number of every cached frame
+        return True
+
+    def build(self, capture, length):
+        print('Caching video frames for GUI mode...')
+        capture.set(cv.CAP_PROP_POS_FRAMES, 0)
+        indices = []
+        # the metadata is written after the frames, so that load() never finds an unfinished cache
+        with atomic_write(self.path, 'wb') as f:
+            nframe = 0
+            while True:
+                # skipped frames are only grabbed, not converted
+                if nframe % self.step:
+                    if not capture.grab():
+                        break
+                    nframe += 1
+                    continue
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                if frame.shape[1::-1] != self.size:
+                    frame = cv.resize(frame, self.size, interpolation=cv.INTER_AREA)
+                f.write(frame.tobytes())
+                indices.append(nframe)
+                nframe += 1
+                print(f'Cached {len(indices)} frames. Progress: {round(nframe/length*100, 1) if length > 0 else 0}%.', end='\r')
+        print()
+
+        with atomic_write(self.meta_path) as outfile:
+            json.dump({'video': self.video_path, 'frames': len(indices), 'indices': indices}, outfile)
+
+    def __len__(self):
+        return len(self.frames)
+
+    # returns cached frame i, a read-only view of the memory-mapped cache
+    def __getitem__(self, i):
+        return self.frames[i]
@@ -0,0 +1,192 @@
+import tracemalloc
+import numpy as np
+import cv2 as cv
+
+# Base class of the per-frame processing contexts (see Masker.create_context). A context allocates
+# the full-frame mask 'inverted' used by apply_mask.
+class MaskContext:
+
+    # decodes the next frame of 'capture'
+    def read(self, capture):
+        return capture.read()
+
+    # sets the pixels of 'frame' outside of the mask to zero, in place
+    def apply_mask(self, frame, mask):
+        cv.bitwise_not(mask, dst=self.inverted)
+        cv.bitwise_xor(frame, frame, dst=frame, mask=self.inverted)
+        return frame
+
+
+# Frame-processing context for a fixed HSV filter and frame resolution. It produces the same
+# masks as Masker.create_mask, but every intermediate array (blurred/equalized frame, CLAHE
+# object, split channels, HSV frame, thresholds, masks, close kernel, labels) is allocated once
+# and reused across frames through OpenCV 'dst=' parameters and in-place NumPy operations.
+# The returned mask and frame are owned by the context and overwritten by the next call.
+# A context is not thread-safe: use one per thread.
+class FrameContext(MaskContext):
+
+    def __init__(self, masker, hsv_filter):
+        self.masker = masker
+        self.hsv_filter = hsv_filter
+        self.shape = None
+
+        # HSV filter range thresholds
+        self.ranges = [((hsv_filter.hMin, hsv_filter.sMin, hsv_filter.vMin), (hsv_filter.hMax, hsv_filter.sMax, hsv_filter.vMax))]
+        self.ranges += [((r['hMin'], r['sMin'], r['vMin']), (r['hMax'], r['sMax'], r['vMax'])) for r in hsv_filter.ranges]
+
+        self.blur_kernel_size = masker.get_kernel_size(hsv_filter.blur) if hsv_filter.blur > 0 else None
+        self.clahe = cv.createCLAHE(clipLimit=2.0, tileGridSize=(8,8)) if hsv_filter.clahe else None
+        self.close_kernel = None
+        if hsv_filter.close > 0:
+            close_kernel_size = masker.get_kernel_size(hsv_filter.close)
+            self.close_kernel = np.ones((close_kernel_size,close_kernel_size),np.uint8)
+
+    # (re)allocates the frame buffers when the resolution changes
+    def allocate(self, shape):
+        h, w = shape[:2]
+        self.shape = shape
+        self.frame = np.empty((h,w,3), np.uint8) # decoded frame, see read()
+        self.blurred = np.empty((h,w,3), np.uint8) if self.blur_kernel_size else None
+        self.equalized = np.empty((h,w,3), np.uint8) if self.clahe else None
+        self.channels = [np.empty((h,w), np.uint8) for _ in range(3)]
+        self.hsv = np.empty((h,w,3), np.uint8)
+        self.mask = np.empty((h,w), np.uint8)
+        self.range_mask = np.empty((h,w), np.uint8) if len(self.ranges) > 1 else None
+        self.inverted = np.empty((h,w), np.uint8)
+        self.closed = np.empty((h,w), np.uint8) if self.close_kernel is not None else None
+        self.labels = np.empty((h,w), np.int32) if self.hsv_filter.engine == 'components' else None
+        # gather indices for the lookup table and the component relabelling. NumPy converts any
+        # other index type to intp with a full-frame temporary array on every gather.
+        self.index = None
+        if self.labels is not None or self.masker.compiled_filter is not None:
+            self.index = np.empty((h,w), np.intp)
+
+    # decodes the next frame of 'capture' into the context frame buffer
+    def read(self, capture):
+        if self.shape is None:
+            self.allocate((self.masker.h, self.masker.w, 3))
+        return capture.read(self.frame)
+
+    # applies the HSV filter to the frame, same as Masker.create_mask
+    def create_mask(self, frame):
+        if frame.shape != self.shape:
+            self.allocate(frame.shape)
+        hsv_filter = self.hsv_filter
+
+        if self.blur_kernel_size:
+            # Apply Gaussian blur
+            k = self.blur_kernel_size
+            frame = cv.GaussianBlur(frame, (k,k), 0, dst=self.blurred)
+
+        if self.clahe:
+            # Apply CLAHE to each component of the frame
+            cv.split(frame, self.channels)
+            for c in self.channels:
+                self.clahe.apply(c, dst=c)
+            frame = cv.merge(self.channels, dst=self.equalized)
+
+        compiled_filter = self.masker.compiled_filter
+        if compiled_filter is not None and compiled_filter.matches(hsv_filter):
+            # Gather the mask from the compiled lookup table ('clip' avoids the temporary
+            # output buffer NumPy uses with the default 'raise' mode)
+            index = self.index
+            np.copyto(index, frame[:,:,0])
+            index <<= 8
+            np.bitwise_or(index, frame[:,:,1], out=index)
+            index <<= 8
+            np.bitwise_or(index, frame[:,:,2], out=index)
+            mask = np.take(compiled_filter.table, index, out=self.mask, mode='clip')
+        else:
+            # Convert BGR frame to HSV and adjust S/V with saturating arithmetic, which gives the
+            # same result as Masker.shift_channel (including the V channel using sSub)
+            cv.cvtColor(frame, cv.COLOR_BGR2HSV, dst=self.hsv)
+            h, s, v = cv.split(self.hsv, self.channels)
+            if hsv_filter.sAdd:
+                cv.add(s, hsv_filter.sAdd, dst=s)
+            if hsv_filter.sSub:
+                cv.subtract(s, hsv_filter.sSub, dst=s)
+            if hsv_filter.vAdd:
+                cv.add(v, hsv_filter.vAdd, dst=v)
+            if hsv_filter.sSub:
+                cv.subtract(v, hsv_filter.sSub, dst=v)
+            cv.merge(self.channels, dst=self.hsv)
+
+            lower, upper = self.ranges[0]
+            mask = cv.inRange(self.hsv, lower, upper, dst=self.mask)
+            for lower, upper in self.ranges[1:]:
+                cv.inRange(self.hsv, lower, upper, dst=self.range_mask)
+                cv.bitwise_or(mask, self.range_mask, dst=mask)
+
+        if hsv_filter.engine == 'components':
+            self.apply_component_filter(mask, hsv_filter.object, hsv_filter.hole)
+        else:
+            self.apply_contour_filter(mask, hsv_filter.object, hsv_filter.hole)
+
+        if self.close_kernel is not None:
+            # Remove small noise
+            mask = cv.morphologyEx(mask, cv.MORPH_CLOSE, self.close_kernel, dst=self.closed)
+
+        return mask, frame, hsv_filter
+
+    # in-place version of Masker.apply_contour_filter
+    def apply_contour_filter(self, mask, object_filter, hole_filter):
+        cnts = cv.findContours(mask, cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE)
+        cnts = cnts[0] if len(cnts) == 2 else cnts[1]
+        cv.drawContours(mask, [c for c in cnts if cv.contourArea(c) < object_filter], -1, 0, -1)
+
+        inverted = cv.bitwise_not(mask, dst=self.inverted)
+        cnts = cv.findContours(inverted, cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE)
+        cnts = cnts[0] if len(cnts) == 2 else cnts[1]
+        cv.drawContours(inverted, [c for c in cnts if cv.contourArea(c) < hole_filter], -1, 0, -1)
+        cv.bitwise_not(inverted, dst=mask)
+
+    # in-place version of Masker.apply_component_filter
+    def apply_component_filter(self, mask, object_filter, hole_filter):
+        if object_filter > 0:
+            _, labels, stats, _ = cv.connectedComponentsWithStats(mask, labels=self.labels, connectivity=8)
+            keep = stats[:, cv.CC_STAT_AREA] >= object_filter
+            keep[0] = False
+            np.copyto(self.index, labels)
+            np.take(np.where(keep, 255, 0).astype(np.uint8), self.index, out=mask, mode='clip')
+
+        if hole_filter > 0:
+            inverted = cv.bitwise_not(mask, dst=self.inverted)
+            _, labels, stats, _ = cv.connectedComponentsWithStats(inverted, labels=self.labels, connectivity=4)
+            fill = stats[:, cv.CC_STAT_AREA] < hole_filter
+            fill[0] = False
+            np.copyto(self.index, labels)
+            np.take(np.where(fill, 255, 0).astype(np.uint8), self.index, out=inverted, mode='clip')
+            cv.bitwise_or(mask, inverted, dst=mask)
+
+
+# Counts the bytes allocated by Python/NumPy (including arrays returned by OpenCV) while
+# processing each frame, measured as the tracemalloc peak above the memory in use when the
+# frame started. Buffers allocated inside OpenCV's C++ code are not visible to tracemalloc.
+class AllocationCounter:
+
+    def __init__(self):
+        self.frames = 0
+        self.total = 0
+        self.max = 0
+        self.baseline = 0
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def begin_frame(self):
+        tracemalloc.reset_peak()
+        self.baseline = tracemalloc.get_traced_memory()[0]
+
+    def end_frame(self):
+        allocated = tracemalloc.get_traced_memory()[1] - self.baseline
+        self.frames += 1
+        self.total += allocated
+        self.max = max(self.max, allocated)
+
+    def report(self):
+        if self.frames:
+            print(f'Allocations per frame: mean {self.total/self.frames/1024:.1f} KiB, max {self.max/1024:.1f} KiB.')
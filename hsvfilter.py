@@ -23,12 +23,28 @@ class HSVfilter:
             "blur": {"type": "integer","minimum": 0,"maximum": 20},
             "close": {"type": "integer","minimum": 0,"maximum": 20},
             "object": {"type": "integer","minimum": 0,"maximum": 25000},
-            "hole": {"type": "integer","minimum": 0,"maximum": 25000}
+            "hole": {"type": "integer","minimum": 0,"maximum": 25000},
+            "engine": {"type": "string","enum": ["contour", "components"]},
+            "ranges": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "hMin": {"type": "integer","minimum": 0,"maximum": 179},
+                        "sMin": {"type": "integer","minimum": 0,"maximum": 255},
+                        "vMin": {"type": "integer","minimum": 0,"maximum": 255},
+                        "hMax": {"type": "integer","minimum": 0,"maximum": 179},
+                        "sMax": {"type": "integer","minimum": 0,"maximum": 255},
+                        "vMax": {"type": "integer","minimum": 0,"maximum": 255}
+                    },
+                    "required": ["hMin", "sMin", "vMin", "hMax", "sMax", "vMax"]
+                }
+            }
         }
     }
 
     def __init__(self, hMin=0, sMin=0, vMin=0, hMax=179, sMax=255, vMax=255, sAdd=0,
-                 sSub=0, vAdd=0, vSub=0, Clahe=0, Blur=0, Close=0, Object=0, Hole=0):
+                 sSub=0, vAdd=0, vSub=0, Clahe=0, Blur=0, Close=0, Object=0, Hole=0, Ranges=None, Engine='contour'):
         self.hMin = hMin
         self.sMin = sMin
         self.vMin = vMin
@@ -44,10 +60,13 @@ class HSVfilter:
         self.close = Close
         self.object = Object
         self.hole = Hole
+        # additional HSV ranges whose pixels are added to the mask, e.g. a hue band wrapping around 0/179
+        self.ranges = Ranges if Ranges else []
+        # object/hole removal method: 'contour' (contour area) or 'components' (connected component pixel count)
+        self.engine = Engine
 
-    def save_to_file(self, output_folder):
+    def to_dict(self):
 
-        output_file = os.path.join(output_folder,'hsv_parameters_from_GUI.json')
         hsv_parameters = {
             "hMin" : self.hMin,
             "sMin" : self.sMin,
@@ -65,6 +84,17 @@ class HSVfilter:
             "object" : self.object,
             "hole" : self.hole
         }
+        if self.ranges:
+            hsv_parameters["ranges"] = self.ranges
+        if self.engine != 'contour':
+            hsv_parameters["engine"] = self.engine
+
+        return hsv_parameters
+
+    def save_to_file(self, output_folder, filename='hsv_parameters_from_GUI.json'):
+
+        output_file = os.path.join(output_folder,filename)
+        hsv_parameters = self.to_dict()
 
         with open(output_file, "w") as outfile: 
             json.dump(hsv_parameters, outfile)
@@ -108,3 +138,5 @@ class HSVfilter:
         self.close = hsv_dict['close']
         self.object = hsv_dict['object']
         self.hole = hsv_dict['hole']
+        self.ranges = hsv_dict.get('ranges', [])
+        self.engine = hsv_dict.get('engine', 'contour')
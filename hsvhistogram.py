@@ -0,0 +1,180 @@
+import copy
+import functools
+import hashlib
+import itertools
+import json
+import os
+import numpy as np
+import cv2 as cv
+from cachedir import atomic_write, get_cache_dir
+
+# filter parameters the histogram depends on, see stagecache.STAGES
+HISTOGRAM_PARAMETERS = ['blur', 'clahe', 'sAdd', 'sSub', 'vAdd']
+# HSV filter range thresholds, in the order of a box: (hMin, hMax, sMin, sMax, vMin, vMax)
+BOX_PARAMETERS = ['hMin', 'hMax', 'sMin', 'sMax', 'vMin', 'vMax']
+PARAMETER_LIMITS = {'h': 179, 's': 255, 'v': 255}
+
+
+# Cumulative 3D histogram of the HSV values of a set of frames, after the blur/CLAHE preprocessing
+# and the S/V adjustments of an HSV filter. The histogram is stored as a summed-volume table: the
+# number of pixels inside any hMin..hMax/sMin..sMax/vMin..vMax box (bounds inclusive, as cv.inRange)
+# is read from 8 table entries, so the threshold coverage of a filter is known without masking a
+# single frame. Only the HSV thresholds can change between queries: the histogram has to be rebuilt
+# for other blur, CLAHE or S/V adjustment parameters. Coverage is measured before the object/hole
+# filters and the close operator.
+class HSVHistogram:
+
+    SHAPE = (180, 256, 256)
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.total = int(counts.sum())
+        # zero-padded cumulative sums along H, S and V
+        table = np.zeros((181, 257, 257), np.int64)
+        table[1:, 1:, 1:] = counts.cumsum(0).cumsum(1).cumsum(2)
+        self.table = table
+
+    # histogram of the HSV values of 'frames' (only the pixels of 'masks' when given), with the
+    # preprocessing and S/V adjustments of 'hsv_filter'
+    @classmethod
+    def from_frames(cls, masker, frames, hsv_filter, masks=None):
+        counts = np.zeros(cls.SHAPE[0]*cls.SHAPE[1]*cls.SHAPE[2], np.int64)
+        masks = masks if masks is not None else itertools.repeat(None)
+        for frame, mask in zip(frames, masks):
+            processed = masker.preprocess_frame(frame, hsv_filter)
+            hsv_frame = masker.convert_hsv(processed, hsv_filter)
+            h, s, v = cv.split(hsv_frame)
+            index = (h.astype(np.int32) << 16) | (s.astype(np.int32) << 8) | v
+            if mask is not None:
+                index = index[mask > 0]
+            counts += np.bincount(index.reshape(-1), minlength=counts.size)
+        return cls(counts.reshape(cls.SHAPE))
+
+    # the counts are stored sparsely: sampled frames only fill a small part of the HSV space
+    def save(self, path):
+        index = np.flatnonzero(self.counts)
+        with atomic_write(path, 'wb') as f:
+            np.savez_compressed(f, index=index.astype(np.uint32), counts=self.counts.reshape(-1)[index])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            counts = np.zeros(cls.SHAPE[0]*cls.SHAPE[1]*cls.SHAPE[2], np.int64)
+            counts[data['index']] = data['counts']
+        return cls(counts.reshape(cls.SHAPE))
+
+    # number of pixels in the boxes (hMin, hMax, sMin, sMax, vMin, vMax). Bounds may be arrays, which
+    # evaluates many boxes at once. Empty boxes (a min above its max) count 0.
+    def box_count(self, hMin, hMax, sMin, sMax, vMin, vMax):
+        h0, h1 = np.clip(hMin, 0, 180), np.clip(np.add(hMax, 1), 0, 180)
+        s0, s1 = np.clip(sMin, 0, 256), np.clip(np.add(sMax, 1), 0, 256)
+        v0, v1 = np.clip(vMin, 0, 256), np.clip(np.add(vMax, 1), 0, 256)
+        t = self.table
+        count = (t[h1, s1, v1] - t[h0, s1, v1] - t[h1, s0, v1] - t[h1, s1, v0]
+                 + t[h0, s0, v1] + t[h0, s1, v0] + t[h1, s0, v0] - t[h0, s0, v0])
+        empty = (h1 <= h0) | (s1 <= s0) | (v1 <= v0)
+        return np.where(empty, 0, count)
+
+    # number of pixels in the union of 'boxes', by inclusion-exclusion over their intersections
+    def union_count(self, boxes):
+        count = 0
+        for n in range(1, len(boxes)+1):
+            for subset in itertools.combinations(boxes, n):
+                intersection = [functools.reduce(np.maximum if i % 2 == 0 else np.minimum,
+                                                 [box[i] for box in subset]) for i in range(6)]
+                count = count + (-1)**(n+1) * self.box_count(*intersection)
+        return count
+
+    # number of pixels masked by the HSV thresholds of 'hsv_filter', including its additional ranges
+    def filter_count(self, hsv_filter, **bounds):
+        return self.union_count(get_boxes(hsv_filter, **bounds))
+
+    # fraction of the pixels masked by the HSV thresholds of 'hsv_filter'
+    def coverage(self, hsv_filter):
+        return float(self.filter_count(hsv_filter)/self.total) if self.total else 0.0
+
+
+# returns the HSV boxes of a filter, the main range first. 'bounds' overrides main range parameters.
+def get_boxes(hsv_filter, **bounds):
+    main = tuple(bounds.get(p, getattr(hsv_filter, p)) for p in BOX_PARAMETERS)
+    ranges = [tuple(r[p] for p in BOX_PARAMETERS) for r in hsv_filter.ranges]
+    return [main] + ranges
+
+
+# yields up to 'nframes' frames evenly spaced over the video of 'masker'
+def sample_frames(masker, nframes):
+    step = max(1, masker.length//nframes) if masker.length > 0 else 1
+    masker.capture.set(cv.CAP_PROP_POS_FRAMES, 0)
+    nframe, sampled = 0, 0
+    while sampled < nframes:
+        # skipped frames are only grabbed, not converted
+        if nframe % step:
+            if not masker.capture.grab():
+                break
+        else:
+            ret, frame = masker.capture.read()
+            if not ret:
+                break
+            sampled += 1
+            yield frame
+        nframe += 1
+
+
+# returns the histogram of 'nframes' frames sampled from the video of 'masker', cached on disk. The
+# cache is rebuilt when the video file is modified or the preprocessing/S/V adjustments change.
+def load_histogram(masker, hsv_filter, nframes, cache_dir=None):
+    cache_dir = cache_dir if cache_dir else get_cache_dir('histograms')
+    stat = os.stat(masker.video_path)
+    parameters = [masker.video_path, stat.st_size, stat.st_mtime_ns, nframes,
+                  [getattr(hsv_filter, p) for p in HISTOGRAM_PARAMETERS]]
+    key = hashlib.sha1(json.dumps(parameters).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f'histogram_{key}.npz')
+    try:
+        return HSVHistogram.load(path)
+    except (FileNotFoundError, ValueError, OSError, KeyError):
+        pass
+
+    print(f'Computing the HSV histogram of {nframes} sampled frames...')
+    histogram = HSVHistogram.from_frames(masker, sample_frames(masker, nframes), hsv_filter)
+    histogram.save(path)
+    return histogram
+
+
+# returns the value of a main range 'parameter' of 'hsv_filter' whose coverage is closest to 'target'
+def search_coverage(histogram, hsv_filter, target, parameter):
+    values = np.arange(PARAMETER_LIMITS[parameter[0]]+1)
+    coverage = histogram.filter_count(hsv_filter, **{parameter: values})/histogram.total
+    best = int(np.argmin(np.abs(coverage-target)))
+    return int(values[best]), float(coverage[best])
+
+
+# IoU of the threshold mask of 'hsv_filter' and the labelled pixels, see search_labels
+def labels_iou(positives, totals, hsv_filter, **bounds):
+    true_positives = positives.filter_count(hsv_filter, **bounds)
+    union = totals.filter_count(hsv_filter, **bounds) + positives.total - true_positives
+    return np.where(union > 0, true_positives/np.maximum(union, 1), 0.0)
+
+
+# Fits the main range of 'hsv_filter' to labelled pixels: 'positives' is the histogram of the
+# pixels labelled as masked, 'totals' the histogram of all pixels of the labelled frames. The six
+# bounds are optimised one at a time (every value of a bound is evaluated at once) until the IoU
+# of the threshold mask and the labels stops improving. Returns the fitted filter and its IoU.
+def search_labels(positives, totals, hsv_filter, max_sweeps=20):
+    fitted = copy.copy(hsv_filter)
+    bounds = {p: getattr(hsv_filter, p) for p in BOX_PARAMETERS}
+    best_iou = float(labels_iou(positives, totals, hsv_filter))
+    for _ in range(max_sweeps):
+        improved = False
+        for parameter in BOX_PARAMETERS:
+            values = np.arange(PARAMETER_LIMITS[parameter[0]]+1)
+            iou = labels_iou(positives, totals, fitted, **{**bounds, parameter: values})
+            best = int(np.argmax(iou))
+            if iou[best] > best_iou + 1e-12:
+                best_iou = float(iou[best])
+                bounds[parameter] = int(values[best])
+                improved = True
+        if not improved:
+            break
+    for parameter, value in bounds.items():
+        setattr(fitted, parameter, value)
+    return fitted, best_iou
@@ -0,0 +1,111 @@
+import math
+import numpy as np
+import cv2 as cv
+from framecontext import MaskContext
+
+# Incremental mask computation for mostly static footage. Every frame is compared block by block
+# with the frame content the current mask was computed from, and the HSV threshold mask is only
+# recomputed for blocks whose mean absolute difference exceeds 'threshold', plus 'margin' blocks
+# around them. The other blocks keep their previous threshold mask. Blocks are recomputed with a
+# halo of half the blur kernel, and a change reaches the blurred pixels up to that halo away, so
+# the margin covers at least the halo (by default the smallest number of blocks that does). The
+# threshold mask then stays identical to a full recomputation within the change threshold. The
+# object/hole filter and the close operator depend on whole regions and run on the full mask
+# whenever any block changed.
+# CLAHE equalizes with statistics of the whole frame, so with CLAHE every frame is recomputed.
+class IncrementalMasker(MaskContext):
+
+    def __init__(self, masker, hsv_filter, block_size=64, threshold=2.0, margin=None):
+        self.masker = masker
+        self.hsv_filter = hsv_filter
+        self.block_size = block_size
+        self.threshold = threshold
+        self.shape = None
+
+        blur_kernel_size = masker.get_kernel_size(hsv_filter.blur) if hsv_filter.blur > 0 else None
+        self.halo = blur_kernel_size//2 if blur_kernel_size else 0
+        self.margin = max(1, math.ceil(self.halo/block_size), margin if margin else 0)
+
+        self.reused = [] # fraction of reused blocks per frame
+        self.status = ''
+
+    def allocate(self, shape):
+        h, w = shape[:2]
+        self.shape = shape
+        self.blocks = (-(-h//self.block_size), -(-w//self.block_size)) # block rows, block columns
+        self.reference = np.empty((h,w,3), np.uint8) # frame content the threshold mask was computed from
+        self.threshold_mask = np.empty((h,w), np.uint8)
+        self.mask = None
+        self.inverted = np.empty((h,w), np.uint8)
+        kernel_size = 2*self.margin+1
+        self.margin_kernel = np.ones((kernel_size,kernel_size), np.uint8)
+
+    # returns a (block rows, block columns) boolean array of the blocks that changed
+    def get_changed_blocks(self, frame):
+        diff = cv.absdiff(frame, self.reference)
+        # mean absolute difference of every block and channel
+        means = cv.resize(diff, (self.blocks[1], self.blocks[0]), interpolation=cv.INTER_AREA)
+        changed = (means.max(axis=2) > self.threshold).astype(np.uint8)
+        if self.margin > 0:
+            changed = cv.dilate(changed, self.margin_kernel)
+        return changed > 0
+
+    # yields the pixel rectangles (y0, y1, x0, x1) of horizontal runs of changed blocks
+    def get_changed_regions(self, changed):
+        b = self.block_size
+        h, w = self.shape[:2]
+        for row in range(changed.shape[0]):
+            cols = np.flatnonzero(changed[row])
+            if not len(cols):
+                continue
+            for run in np.split(cols, np.flatnonzero(np.diff(cols) > 1)+1):
+                yield row*b, min((row+1)*b, h), run[0]*b, min((run[-1]+1)*b, w)
+
+    def threshold_region(self, frame, region):
+        y0, y1, x0, x1 = region
+        h, w = self.shape[:2]
+        cy0, cy1, cx0, cx1 = max(0,y0-self.halo), min(h,y1+self.halo), max(0,x0-self.halo), min(w,x1+self.halo)
+        crop = self.masker.preprocess_frame(frame[cy0:cy1, cx0:cx1], self.hsv_filter)
+        mask = self.masker.threshold_frame(crop, self.hsv_filter)
+        self.threshold_mask[y0:y1, x0:x1] = mask[y0-cy0:y1-cy0, x0-cx0:x1-cx0]
+        self.reference[y0:y1, x0:x1] = frame[y0:y1, x0:x1]
+
+    # applies the HSV filter to the frame, reusing the mask of unchanged blocks. The processed
+    # frame is not assembled, the input frame is returned in its place.
+    def create_mask(self, frame):
+        hsv_filter = self.hsv_filter
+        if frame.shape != self.shape:
+            self.allocate(frame.shape)
+            changed = None
+        elif hsv_filter.clahe:
+            changed = None
+        else:
+            changed = self.get_changed_blocks(frame)
+
+        if changed is None:
+            # full recomputation
+            processed = self.masker.preprocess_frame(frame, hsv_filter)
+            self.threshold_mask[:] = self.masker.threshold_frame(processed, hsv_filter)
+            self.reference[:] = frame
+            reused = 0.0
+        else:
+            reused = 1.0 - changed.mean()
+            if reused == 1.0 and self.mask is not None:
+                self.record(reused)
+                return self.mask, frame, hsv_filter
+            for region in self.get_changed_regions(changed):
+                self.threshold_region(frame, region)
+
+        # clean_mask may draw into its input, the threshold mask must survive for the next frame
+        self.mask = self.masker.clean_mask(self.threshold_mask.copy(), hsv_filter)
+        self.record(reused)
+        return self.mask, frame, hsv_filter
+
+    def record(self, reused):
+        self.reused.append(reused)
+        self.status = f'Reused blocks: {reused*100:.1f}%.'
+
+    def report(self):
+        if self.reused:
+            print(f'Reused {np.mean(self.reused)*100:.1f}% of the mask blocks on average '
+                  f'({sum(1 for r in self.reused if r == 1.0)} of {len(self.reused)} frames fully reused).')
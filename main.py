@@ -1,6 +1,26 @@
 from masker import Masker
 import click
 
+def parse_roi(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        x, y, w, h = (int(v) for v in value.split(','))
+    except ValueError:
+        raise click.BadParameter("expected x,y,w,h, e.g. 0,540,1920,540")
+    return x, y, w, h
+
+def parse_fill(ctx, param, value):
+    if value == 'pass':
+        return None
+    try:
+        fill = int(value)
+    except ValueError:
+        fill = -1
+    if not 0 <= fill <= 255:
+        raise click.BadParameter("expected 'pass' or a gray level from 0 to 255")
+    return fill
+
 @click.command()
 @click.option('-i', 'inputfile', type=click.Path(exists=True,resolve_path=True), required=True)
 @click.option('-o', 'outputfolder', type=click.Path(resolve_path=True), default=None, required=False, help='Specify folder to save masked video.')
@@ -8,16 +28,78 @@ import click
               help='JSON file path with HSV filter parameters. Expected format: {"hMin": 0, "sMin": 0, "vMin": 0, "hMax": 179, "sMax": 255, "vMax": 255, "sAdd": 0, "sSub": 0, "vAdd": 0, "vSub": 0, "blur": 0, "close": 0, "object": 0, "hole": 0}. Filter parameters and value ranges: MinHue (0 to 179), MinSaturation (0 to 255), MinValue (0 to 255), MaxHue (0 to 179), MaxSaturation (0 to 255), MaxValue (0 to 255), SaturationAdd (0 to 255), SaturationSubtract (0 to 255), ValueAdd (0 to 255), ValueSubtract (0 to 255), Clahe (0 or 1, switch on CLAHE application per frame before masking), Blur (0 to 10, increases kernel size), Close (0 to 10, increases kernel size), Small Object Removal (0 to 25000 in pixels), Small Hole Removal (0 to 25000 in pixels)')
 @click.option('-guimode/-no-guigmode', 'guimode', default=False,
             help='Launches a GUI with two windows, one loops the input video and the other the current mask per frame. Includes trackbars for HSV filter parameters to find the appropriate mask thresholds in real time.' )
+@click.option('--workers', 'workers', type=click.IntRange(min=1), default=1,
+              help='Number of mask worker threads. Values above 1 run decoding, masking and encoding as a pipeline on separate threads, keeping the frame order.')
+@click.option('--queue-depth', 'queue_depth', type=click.IntRange(min=1), default=8,
+              help='Maximum number of frames waiting between the pipeline stages when --workers is above 1. Bounds the memory used by the pipeline.')
+@click.option('--segments', 'segments', type=click.IntRange(min=1), default=1,
+              help='Number of processes masking separate frame ranges of the video in parallel. The masked segments are joined into the output video (by stream copy when ffmpeg is installed).')
+@click.option('--compiled/--no-compiled', 'compiled', default=False,
+              help='Thresholds frames through a lookup table precomputed for the HSV filter (cached on disk) instead of converting every frame to HSV. Produces identical masks.')
+@click.option('--reuse-buffers/--no-reuse-buffers', 'reuse_buffers', default=False,
+              help='Allocates the frame processing buffers once and reuses them for every frame instead of allocating new arrays per frame. Produces identical masks.')
+@click.option('--track-allocations', 'track_allocations', is_flag=True, default=False,
+              help='Measures the bytes allocated per frame and prints a summary at the end (single-threaded export only, slows down processing).')
+@click.option('--tile-size', 'tile_size', type=click.IntRange(min=64), default=None,
+              help='Processes every frame in square tiles of this size (in pixels) on a thread pool, bounding the temporary memory by the tile size. Intended for very large frames.')
+@click.option('--incremental', 'incremental', is_flag=True, default=False,
+              help='Recomputes the HSV mask only for the blocks of the frame that changed since the previous frame and reuses the previous mask elsewhere. Intended for slow-moving footage.')
+@click.option('--block-size', 'block_size', type=click.IntRange(min=8), default=64,
+              help='Block size in pixels for --incremental.')
+@click.option('--change-threshold', 'change_threshold', type=click.FloatRange(min=0), default=2.0,
+              help='Mean absolute pixel difference above which a block is recomputed with --incremental.')
+@click.option('--mask-scale', 'mask_scale', type=click.FloatRange(min=0.05, max=1), default=None,
+              help='Computes the mask on frames downscaled by this factor (e.g. 0.5) and upsamples it with an edge refinement at full resolution. Object/hole areas and kernel sizes are scaled to match.')
+@click.option('--report-iou', 'report_iou', is_flag=True, default=False,
+              help='With --mask-scale, also computes the full-resolution mask and reports the IoU of the two masks per frame and at the end.')
+@click.option('--refresh-codecs', 'refresh_codecs', is_flag=True, default=False,
+              help='Probes the input video codec again instead of using the cached result of a previous run.')
+@click.option('--profile', 'profile', type=click.Path(resolve_path=True), default=None,
+              help='Times every processing stage (decode, blur, CLAHE, shift_channel, inRange, contour filter, close, encode) and counts the contours per frame. Prints a summary table at the end and saves the stage time histograms to this file (JSON lines, or CSV for a .csv path). Also works in GUI mode.')
+@click.option('--mask-stream', 'mask_stream', is_flag=True, default=False,
+              help='Writes only the masks to a compact, seekable .hsvmask file instead of re-encoding the masked video. Use apply_masks.py to composite the masks onto the video later.')
+@click.option('--batch-size', 'batch_size', type=click.IntRange(min=1), default=1,
+              help='Decodes frames in chunks of this many frames and masks every chunk in one batched pass (HSV conversion and thresholds over the whole chunk). Produces identical masks.')
+@click.option('--checkpoint', 'checkpoint', type=click.IntRange(min=0), default=0,
+              help='Writes the masked video in parts of this many frames and records the progress after every part, so that an interrupted or failed export can be resumed with --resume. The parts are joined at the end.')
+@click.option('--resume', 'resume', is_flag=True, default=False,
+              help='Continues an interrupted checkpointed export of the same video, HSV parameters and options from its last checkpoint. Uses parts of 1000 frames when --checkpoint is not given.')
+@click.option('--skip-corrupt-frames', 'skip_corrupt', is_flag=True, default=False,
+              help='Skips and logs frames that cannot be read before the end of the video instead of stopping the export. Skipped frames are left out of the masked video.')
+@click.option('--roi', 'roi', type=str, default=None, callback=parse_roi,
+              help='Masks only the region of interest x,y,w,h of every frame (pixels, from the top left corner). Pixels outside it are not processed and are passed through or filled, see --roi-fill.')
+@click.option('--roi-fill', 'roi_fill', type=str, default='pass', callback=parse_fill,
+              help="Pixels outside --roi: 'pass' keeps the input pixels, a gray level from 0 to 255 fills them with that constant.")
+@click.option('--start', 'start', type=click.IntRange(min=0), default=0,
+              help='First frame to mask. The frames before it are skipped by seeking, not decoded.')
+@click.option('--end', 'end', type=click.IntRange(min=1), default=None,
+              help='Frame number where masking stops (exclusive). Defaults to the end of the video.')
+@click.option('--stride', 'stride', type=click.IntRange(min=1), default=1,
+              help='Masks every Nth frame from --start. The output frame rate is divided by the stride, so the masked video keeps the duration of the range.')
+@click.option('--gui-cache/--no-gui-cache', 'gui_cache', default=True,
+              help='In GUI mode, decodes a subset of the frames once into a frame cache on disk (reused by later sessions) and plays and scrubs through the cached frames instead of decoding the video on every loop.')
+@click.option('--gui-step', 'gui_step', type=click.IntRange(min=1), default=None,
+              help='Caches every Nth frame for GUI mode. Defaults to a step that keeps at most 300 frames.')
+@click.option('--gui-scale', 'gui_scale', type=click.FloatRange(min=0.05, max=1), default=None,
+              help='Preview scale of the cached GUI frames. Defaults to a preview at most 1280 pixels wide. Object/hole areas and kernel sizes are scaled to match.')
 
-def VideoMasking(inputfile, outputfolder, hsvparams, guimode):
+def VideoMasking(inputfile, outputfolder, hsvparams, guimode, workers, queue_depth, segments, compiled, reuse_buffers, track_allocations,
+                 tile_size, incremental, block_size, change_threshold, mask_scale, report_iou, refresh_codecs, profile, mask_stream, batch_size, checkpoint, resume, skip_corrupt,
+                 roi, roi_fill, start, end, stride, gui_cache, gui_step, gui_scale):
     # Load Video
     video = Masker(inputfile)
     
     if guimode:
         print('Initiating GUI mode. Press Q to exit...')
-        video.init_video_gui()
+        video.init_video_gui(profile, gui_cache, gui_step, gui_scale)
     else:
-        video.mask_and_export(outputfolder, hsvparams)
+        video.mask_and_export(outputfolder, hsvparams, workers=workers, queue_depth=queue_depth, segments=segments,
+                              compiled=compiled, reuse_buffers=reuse_buffers, track_allocations=track_allocations,
+                              tile_size=tile_size, incremental=incremental, block_size=block_size,
+                              change_threshold=change_threshold, mask_scale=mask_scale, report_iou=report_iou,
+                              refresh_codecs=refresh_codecs, profile=profile, mask_stream=mask_stream, batch_size=batch_size,
+                              checkpoint=checkpoint, resume=resume, skip_corrupt=skip_corrupt,
+                              roi=roi, roi_fill=roi_fill, start=start, end=end, stride=stride)
 
 if __name__ == "__main__":
 
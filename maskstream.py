@@ -0,0 +1,146 @@
+import mmap
+import os
+import struct
+import numpy as np
+
+# Compact, seekable storage of the masks of a video, an alternative to re-encoding the masked
+# frames. The file holds a header, one record per distinct mask and a frame index:
+#
+#   header  magic, version, width, height, fps, frame count, index offset, first frame, frame step,
+#           fill and region of interest (HEADER_FORMAT)
+#   record  1 encoding byte + payload, where the payload is
+#             ENCODING_PACKBITS  the mask bits, row by row (np.packbits)
+#             ENCODING_RLE       uint32 run lengths of the flattened mask, alternating 0 and 255
+#                                runs and starting with a (possibly empty) run of 0
+#   index   (offset, size) uint64 pairs of the record of every frame
+#
+# Every mask is stored with the smaller of the two encodings. A frame with the same mask as the
+# previous frame points to the previous record and takes no space. The file is read through a
+# memory map, so any frame can be decoded without reading the rest of the stream.
+#
+# The first frame and frame step record the frame range of the masks (see Masker.set_region),
+# mask i belongs to video frame start+i*stride. With a region of interest (x, y, w, h and a
+# 'fill' gray level, -1 to pass the pixels through) the masks outside it are 255 (pass) or 0
+# (fill). Version 1 streams have no range or region and a 64 byte header.
+
+MAGIC = b'HSVMASK\0'
+VERSION = 2
+HEADER_FORMAT_V1 = '<8sIIIdQQ'
+HEADER_FORMAT = '<8sIIIdQQQQiiiii'
+HEADER_SIZE = 96
+ENCODING_PACKBITS = 0
+ENCODING_RLE = 1
+MASK_STREAM_EXTENSION = '.hsvmask'
+
+
+def encode_mask(mask):
+    flat = mask.reshape(-1) > 0
+    # run lengths between the positions where the mask changes
+    changes = np.flatnonzero(flat[1:] != flat[:-1])+1
+    runs = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat[0]:
+        runs = np.concatenate(([0], runs))
+    if runs.size*4 < (flat.size+7)//8:
+        return bytes([ENCODING_RLE])+runs.astype('<u4').tobytes()
+    return bytes([ENCODING_PACKBITS])+np.packbits(flat).tobytes()
+
+
+def decode_mask(record, width, height):
+    encoding, payload = record[0], record[1:]
+    if encoding == ENCODING_RLE:
+        runs = np.frombuffer(payload, '<u4')
+        values = np.zeros(runs.size, np.uint8)
+        values[1::2] = 255
+        return np.repeat(values, runs).reshape(height, width)
+    if encoding == ENCODING_PACKBITS:
+        bits = np.unpackbits(np.frombuffer(payload, np.uint8), count=width*height)
+        return (bits*255).reshape(height, width)
+    raise ValueError(f'Unknown mask encoding {encoding}.')
+
+
+# Writes a mask stream, with the write/release interface of cv.VideoWriter
+class MaskStreamWriter:
+
+    writes_masks = True # write() takes masks instead of masked frames, see Masker.mask_frames
+
+    def __init__(self, path, fps, resolution, start=0, stride=1, roi=None, fill=None):
+        self.path = path
+        self.fps = fps
+        self.width, self.height = resolution
+        self.start = start
+        self.stride = stride
+        self.roi = tuple(roi) if roi else (0, 0, 0, 0)
+        self.fill = fill if fill is not None else -1
+        self.index = []
+        self.previous = None
+        self.file = open(path, 'wb')
+        self.file.write(bytes(HEADER_SIZE)) # written on release, when the frame count is known
+        self.offset = HEADER_SIZE
+
+    def isOpened(self):
+        return not self.file.closed
+
+    def write(self, mask):
+        if mask.shape != (self.height, self.width):
+            raise ValueError(f'Mask size {mask.shape[1]}x{mask.shape[0]} does not match the stream size {self.width}x{self.height}.')
+        if self.previous is not None and np.array_equal(mask, self.previous):
+            # unchanged mask, the frame points to the previous record
+            self.index.append(self.index[-1])
+        else:
+            record = encode_mask(mask)
+            self.file.write(record)
+            self.index.append((self.offset, len(record)))
+            self.offset += len(record)
+        self.previous = mask.copy()
+
+    def release(self):
+        if self.file.closed:
+            return
+        self.file.write(np.array(self.index, '<u8').reshape(-1, 2).tobytes())
+        self.file.seek(0)
+        self.file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, self.width, self.height, self.fps,
+                                    len(self.index), self.offset, self.start, self.stride, self.fill, *self.roi))
+        self.file.close()
+
+
+# Reads a mask stream through a memory map. Masks are decoded on access: stream[i] returns the
+# mask of frame i, iterating returns the masks in frame order.
+class MaskStream:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.width, self.height, self.fps, self.length, index_offset = \
+            struct.unpack_from(HEADER_FORMAT_V1, self.map)
+        if magic != MAGIC or version not in (1, VERSION):
+            self.map.close()
+            raise ValueError(f'{path} is not a mask stream or was not closed properly.')
+        self.start, self.stride, self.roi, self.fill = 0, 1, None, None
+        if version == VERSION:
+            self.start, self.stride, fill, *roi = struct.unpack_from(HEADER_FORMAT, self.map)[7:]
+            self.roi = tuple(roi) if roi[2] > 0 else None
+            self.fill = fill if fill >= 0 else None
+        self.resolution = (self.width, self.height)
+        self.index = np.frombuffer(self.map, '<u8', count=2*self.length, offset=index_offset).reshape(-1, 2)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if not -self.length <= i < self.length:
+            raise IndexError(f'Frame {i} is out of range, the stream has {self.length} frames.')
+        offset, size = (int(v) for v in self.index[i])
+        return decode_mask(self.map[offset:offset+size], self.width, self.height)
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
+
+    def close(self):
+        self.index = None
+        self.map.close()
+
+    # size of the stream on disk in bytes
+    def size(self):
+        return os.path.getsize(self.path)
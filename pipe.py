@@ -0,0 +1,65 @@
+import contextlib
+import sys
+import time
+import click
+import cv2 as cv
+from hsvfilter import HSVfilter
+from streaming import iter_masks, iter_raw_frames
+
+def parse_size(ctx, param, value):
+    try:
+        width, height = (int(v) for v in value.lower().split('x'))
+    except ValueError:
+        raise click.BadParameter("expected WIDTHxHEIGHT, e.g. 1920x1080")
+    if width <= 0 or height <= 0:
+        raise click.BadParameter("width and height must be positive")
+    return width, height
+
+@click.command()
+@click.option('--size', 'size', type=str, required=True, callback=parse_size,
+              help='Frame size of the raw input frames as WIDTHxHEIGHT, e.g. 1920x1080.')
+@click.option('--fps', 'fps', type=click.FloatRange(min=0, min_open=True), required=True,
+              help='Frame rate of the stream. Raw frames carry no timing, the frame rate is used to report the processed duration.')
+@click.option('-hsv', 'hsvparams', type=click.Path(resolve_path=True), default=None, required=True,
+              help='JSON file path with HSV filter parameters, see main.py -hsv.')
+@click.option('--output', 'output', type=click.Choice(['masked', 'mask']), default='masked',
+              help='Writes the masked bgr24 frames or the gray masks (one byte per pixel, 0 or 255) to stdout.')
+@click.option('--compiled/--no-compiled', 'compiled', default=False,
+              help='Thresholds frames through a cached lookup table, see main.py --compiled.')
+@click.option('--reuse-buffers/--no-reuse-buffers', 'reuse_buffers', default=False,
+              help='Reuses frame processing buffers, see main.py --reuse-buffers.')
+
+# masks raw bgr24 frames from stdin and writes raw frames to stdout, e.g. between ffmpeg processes:
+#   ffmpeg -i in.mp4 -f rawvideo -pix_fmt bgr24 - | python pipe.py --size 1920x1080 --fps 25 -hsv hsv.json |
+#   ffmpeg -f rawvideo -pix_fmt bgr24 -s 1920x1080 -r 25 -i - out.mp4
+# stdout only carries frames, messages are printed to stderr.
+def MaskPipe(size, fps, hsvparams, output, compiled, reuse_buffers):
+    width, height = size
+    stdout = sys.stdout.buffer
+    with contextlib.redirect_stdout(sys.stderr):
+        hsv_filter = HSVfilter()
+        hsv_filter.import_from_file(hsvparams)
+
+        start = time.perf_counter()
+        nframe = 0
+        frames = iter_raw_frames(sys.stdin.buffer, width, height)
+        try:
+            for frame, mask in iter_masks(frames, hsv_filter, compiled, {'reuse_buffers': reuse_buffers}):
+                if output == 'mask':
+                    stdout.write(mask.data)
+                else:
+                    stdout.write(cv.bitwise_and(frame, frame, mask=mask).data) # mask frame
+                nframe += 1
+            stdout.flush()
+        except BrokenPipeError:
+            # the downstream process exited, stop reading
+            print('Output stream closed. Exiting...')
+        except EOFError as e:
+            print(f'ERROR: {e} Check --size. Exiting...')
+
+        elapsed = time.perf_counter()-start
+        print(f'Masked {nframe} frames ({nframe/fps:.1f}s of video) in {elapsed:.1f}s ({nframe/elapsed if elapsed else 0:.1f} fps).')
+
+if __name__ == "__main__":
+
+    MaskPipe()
@@ -0,0 +1,157 @@
+import threading
+import queue
+import cv2 as cv
+
+# Multi-threaded decode -> mask -> encode pipeline used by Masker.mask_and_export.
+# A reader thread decodes frames, a pool of workers computes and applies the masks
+# and a writer thread encodes the masked frames back in their original order.
+# A writer with 'writes_masks' (see MaskStreamWriter) receives the masks instead.
+# OpenCV releases the GIL inside capture.read(), the filtering calls and
+# VideoWriter.write(), so the three stages run concurrently.
+class MaskingPipeline:
+
+    # seconds to wait on a full/empty queue before checking if the pipeline was stopped
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, masker, hsv_filter, workers=2, queue_depth=8, context_options=None, progress=True):
+        self.masker = masker
+        self.hsv_filter = hsv_filter
+        # options of Masker.create_context for the per-worker processing contexts
+        self.context_options = context_options if context_options else {}
+        self.progress = progress
+        self.workers = max(1, workers)
+        self.queue_depth = max(1, queue_depth)
+
+        # bounded queues between the reader, the mask workers and the writer
+        self.read_queue = queue.Queue(maxsize=self.queue_depth)
+        self.write_queue = queue.Queue(maxsize=self.queue_depth)
+        # limits the number of decoded frames alive at the same time (queued, being masked
+        # or waiting for an earlier frame to be written), which keeps memory bounded
+        # even when one worker falls behind the others
+        self.in_flight = threading.BoundedSemaphore(2*self.queue_depth + self.workers)
+
+        self.stop = threading.Event()
+        self.error = None
+        self.nframe = 0 # written frame counter
+        self.write_masks = False # writer receives masks instead of masked frames, set by run()
+
+    # stops all stages after an exception in one of the threads
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+
+    def put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=self.POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return None
+
+    def acquire_slot(self):
+        while not self.stop.is_set():
+            if self.in_flight.acquire(timeout=self.POLL_INTERVAL):
+                return True
+        return False
+
+    def read_frames(self):
+        index = 0
+        try:
+            while self.acquire_slot():
+                ret, frame = self.masker.capture.read() # extract frame
+                if not ret:
+                    self.in_flight.release()
+                    break
+                if not self.put(self.read_queue, (index, frame)):
+                    break
+                index += 1
+        except Exception as e:
+            self.fail(e)
+        finally:
+            # one end marker per worker
+            for _ in range(self.workers):
+                self.put(self.read_queue, None)
+
+    def mask_frames(self):
+        context = None
+        try:
+            # every worker has its own processing context and masks the decoded frame in place
+            context = self.masker.create_context(self.hsv_filter, **self.context_options)
+            while True:
+                item = self.get(self.read_queue)
+                if item is None:
+                    break
+                index, frame = item
+                if context:
+                    mask,_,_ = context.create_mask(frame) # compute mask
+                    if self.write_masks:
+                        frame = mask.copy() # the context mask is overwritten by the next frame
+                    else:
+                        frame = context.apply_mask(frame, mask) # mask frame in place
+                else:
+                    mask,_,_ = self.masker.create_mask(frame, self.hsv_filter) # compute mask
+                    frame = mask if self.write_masks else cv.bitwise_and(frame, frame, mask=mask) # mask frame
+                if not self.put(self.write_queue, (index, frame)):
+                    break
+        except Exception as e:
+            self.fail(e)
+        finally:
+            if hasattr(context, 'close'):
+                context.close()
+            self.put(self.write_queue, None)
+
+    def write_frames(self, masked_video):
+        pending = {} # masked frames that finished before an earlier frame
+        finished_workers = 0
+        try:
+            while finished_workers < self.workers:
+                item = self.get(self.write_queue)
+                if item is None:
+                    if self.stop.is_set():
+                        break
+                    finished_workers += 1
+                    continue
+
+                index, frame = item
+                pending[index] = frame
+                # write every frame that is now next in order
+                while self.nframe in pending:
+                    masked_video.write(pending.pop(self.nframe))
+                    self.in_flight.release()
+                    self.nframe += 1
+                    if self.progress:
+                        self.masker.print_progress(self.nframe)
+        except Exception as e:
+            self.fail(e)
+
+    # runs the pipeline and returns the number of frames written to masked_video
+    def run(self, masked_video):
+        self.write_masks = getattr(masked_video, 'writes_masks', False)
+        threads = [threading.Thread(target=self.read_frames, daemon=True)]
+        threads += [threading.Thread(target=self.mask_frames, daemon=True) for _ in range(self.workers)]
+        threads.append(threading.Thread(target=self.write_frames, args=(masked_video,), daemon=True))
+
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(self.POLL_INTERVAL)
+        except KeyboardInterrupt:
+            self.stop.set()
+            raise
+
+        if self.error is not None:
+            raise self.error
+
+        return self.nframe
@@ -0,0 +1,148 @@
+import contextlib
+import csv
+import json
+import threading
+import time
+from array import array
+import numpy as np
+
+# edges of the stage time histogram bins, in milliseconds
+HISTOGRAM_EDGES_MS = [0, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf')]
+# upper bin edges as saved, the last (unbounded) bin is saved as null/empty
+HISTOGRAM_BINS_MS = HISTOGRAM_EDGES_MS[1:-1]+[None]
+
+
+# times a 'with' block and adds it to a stage of the profiler
+class StageTimer:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, time.perf_counter()-self.start)
+
+
+# Records the time spent in every stage (decode, blur, CLAHE, shift_channel, inRange, contour
+# filter, close, encode ...) and counters (e.g. contours) of every frame. A stage that runs
+# several times in a frame (e.g. once per tile) is summed for the frame. Stages may be timed from
+# several threads, frames are delimited by begin_frame/end_frame on one thread.
+# The histograms of the per-frame stage times are saved to 'output', as JSON lines (one object per
+# stage) or as CSV (one row per stage and histogram bin) when the file name ends with .csv.
+class StageProfiler:
+
+    def __init__(self, output=None):
+        self.output = output
+        self.lock = threading.Lock()
+        self.current = {} # stage times and counters of the current frame
+        self.samples = {} # per-frame values of every stage/counter
+        self.counters = set()
+        self.frames = 0
+        self.frame_start = None
+
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def count(self, name, value):
+        with self.lock:
+            self.counters.add(name)
+            self.current[name] = self.current.get(name, 0) + value
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        self.add('frame', time.perf_counter()-self.frame_start)
+        with self.lock:
+            for name, value in self.current.items():
+                self.samples.setdefault(name, array('d')).append(value)
+            self.current = {}
+            self.frames += 1
+
+    # returns the statistics of every stage, times in milliseconds
+    def get_summary(self):
+        frame_total = sum(self.samples.get('frame', []))
+        summary = {}
+        for name, values in self.samples.items():
+            values = np.frombuffer(values, np.float64)
+            if name in self.counters:
+                summary[name] = {'type': 'counter', 'frames': len(values), 'mean': float(values.mean()),
+                                 'max': float(values.max())}
+                continue
+            values_ms = values*1000
+            histogram, _ = np.histogram(values_ms, HISTOGRAM_EDGES_MS)
+            summary[name] = {'type': 'stage', 'frames': len(values), 'total_s': float(values.sum()),
+                             'mean_ms': float(values_ms.mean()), 'p50_ms': float(np.percentile(values_ms, 50)),
+                             'p95_ms': float(np.percentile(values_ms, 95)), 'max_ms': float(values_ms.max()),
+                             'share': float(values.sum()/frame_total) if frame_total else 0.0,
+                             'histogram_edges_ms': HISTOGRAM_BINS_MS, 'histogram': histogram.tolist()}
+        return summary
+
+    def save(self):
+        if not self.output or not self.frames:
+            return
+        summary = self.get_summary()
+        with open(self.output, 'w', newline='') as outfile:
+            if self.output.lower().endswith('.csv'):
+                writer = csv.writer(outfile)
+                writer.writerow(['stage', 'frames', 'mean_ms', 'p50_ms', 'p95_ms', 'max_ms', 'share', 'bin_upper_ms', 'count'])
+                for name, s in summary.items():
+                    if s['type'] == 'counter':
+                        writer.writerow([name, s['frames'], s['mean'], '', '', s['max'], '', '', ''])
+                        continue
+                    for edge, count in zip(s['histogram_edges_ms'], s['histogram']):
+                        writer.writerow([name, s['frames'], s['mean_ms'], s['p50_ms'], s['p95_ms'], s['max_ms'], s['share'], edge, count])
+            else:
+                for name, s in summary.items():
+                    outfile.write(json.dumps({'stage': name, **s})+'\n')
+        print(f'Profile saved in the following directory:\n {self.output}')
+
+    def report(self):
+        if not self.frames:
+            return
+        summary = self.get_summary()
+        print(f'\nProfile of {self.frames} frames:')
+        print(f'{"stage":<20} {"frames":>7} {"mean ms":>9} {"p50 ms":>9} {"p95 ms":>9} {"max ms":>9} {"share":>7}')
+        stages = sorted((name for name in summary if summary[name]['type'] == 'stage'), key=lambda name: -summary[name]['total_s'])
+        for name in stages:
+            s = summary[name]
+            print(f'{name:<20} {s["frames"]:>7} {s["mean_ms"]:>9.2f} {s["p50_ms"]:>9.2f} {s["p95_ms"]:>9.2f} '
+                  f'{s["max_ms"]:>9.2f} {s["share"]*100:>6.1f}%')
+        for name in sorted(self.counters):
+            s = summary[name]
+            print(f'{name:<20} {s["frames"]:>7} mean {s["mean"]:.1f}, max {s["max"]:.0f} per frame')
+
+
+# Profiler used when profiling is disabled: every hook is a no-op, stages share one null context
+class NullProfiler:
+
+    NULL_STAGE = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self.NULL_STAGE
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, name, value):
+        pass
+
+    def begin_frame(self):
+        pass
+
+    def end_frame(self):
+        pass
+
+    def save(self):
+        pass
+
+    def report(self):
+        pass
@@ -0,0 +1,126 @@
+from collections import deque
+import numpy as np
+import cv2 as cv
+
+# Frame range and region-of-interest processing. The wrappers stand in for the cv.VideoCapture
+# and cv.VideoWriter of a Masker (see Masker.set_region), so every export path (single thread,
+# pipeline, batches, segments, checkpoints) decodes and masks only the selected frames and pixels.
+
+# longest gap between two selected frames that is skipped with grab() instead of a seek. A seek
+# decodes again from the previous key frame, which costs more than grabbing a few frames.
+MAX_GRAB_GAP = 30
+
+
+# Capture of the frames start, start+stride, ... before 'end' of 'capture'. Frame numbers of
+# CAP_PROP_POS_FRAMES and CAP_PROP_FRAME_COUNT count the selected frames only.
+class FrameRangeCapture:
+
+    def __init__(self, capture, start, end, stride):
+        self.capture = capture
+        self.start = start
+        self.stride = stride
+        self.length = len(range(start, end, stride))
+        self.position = 0 # next selected frame
+        self.source = 0 # next frame of 'capture', None after a seek of the selected frames
+
+    # moves 'capture' to the next selected frame, returns False after the last one
+    def advance(self):
+        if self.position >= self.length:
+            return False
+        target = self.start + self.position*self.stride
+        gap = target-self.source if self.source is not None else -1
+        if 0 < gap <= MAX_GRAB_GAP:
+            for _ in range(gap):
+                self.capture.grab()
+        elif gap != 0:
+            self.capture.set(cv.CAP_PROP_POS_FRAMES, target)
+        self.source = target+1
+        self.position += 1
+        return True
+
+    def read(self, image=None):
+        if not self.advance():
+            return False, None
+        return self.capture.read(image)
+
+    def grab(self):
+        return self.advance() and self.capture.grab()
+
+    def get(self, prop):
+        if prop == cv.CAP_PROP_FRAME_COUNT:
+            return self.length
+        if prop == cv.CAP_PROP_POS_FRAMES:
+            return self.position
+        return self.capture.get(prop)
+
+    def set(self, prop, value):
+        if prop == cv.CAP_PROP_POS_FRAMES:
+            self.position = int(value)
+            self.source = None
+            return True
+        return self.capture.set(prop, value)
+
+    def __getattr__(self, name):
+        return getattr(self.capture, name)
+
+
+# Capture returning the (x, y, w, h) region of interest of every frame of 'capture'. With
+# 'keep_frames' the full frames are queued for RoiWriter, which passes their pixels outside the
+# region through. A ROI-sized 'image' (e.g. the batch stack) receives a copy of the region,
+# otherwise a view of the region of the decoded frame is returned.
+class RoiCapture:
+
+    def __init__(self, capture, roi, keep_frames):
+        self.capture = capture
+        self.roi = roi
+        self.frames = deque() if keep_frames else None
+
+    def read(self, image=None):
+        x, y, w, h = self.roi
+        if image is not None and image.shape[:2] == (h, w):
+            ret, full = self.capture.read()
+            if ret:
+                np.copyto(image, full[y:y+h, x:x+w])
+                frame = image
+        else:
+            ret, full = self.capture.read(image)
+            if ret:
+                frame = full[y:y+h, x:x+w]
+        if not ret:
+            return False, None
+        if self.frames is not None:
+            self.frames.append(full)
+        return True, frame
+
+    def __getattr__(self, name):
+        return getattr(self.capture, name)
+
+
+# Writer placing the masked region (or its mask, for a writer with 'writes_masks') back into a full
+# frame. Outside the region the frames of 'frames' (see RoiCapture) are passed through or, without
+# them, the gray level 'fill' is written. Masks are 255 (pass through) or 0 (fill) outside the region.
+class RoiWriter:
+
+    def __init__(self, writer, roi, resolution, fill=None, frames=None):
+        self.writer = writer
+        self.roi = roi
+        self.frames = frames
+        self.writes_masks = getattr(writer, 'writes_masks', False)
+        w, h = resolution
+        if self.writes_masks:
+            self.canvas = np.full((h, w), 255 if frames is not None else 0, np.uint8)
+        else:
+            self.canvas = np.full((h, w, 3), fill if fill is not None else 0, np.uint8)
+
+    def write(self, frame):
+        x, y, w, h = self.roi
+        full = self.frames.popleft() if self.frames is not None else None
+        if full is None or self.writes_masks:
+            full = self.canvas
+        region = full[y:y+h, x:x+w]
+        if not np.shares_memory(region, frame):
+            region[...] = frame # masked in place otherwise
+        self.writer.write(full)
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
@@ -0,0 +1,128 @@
+import copy
+import numpy as np
+import cv2 as cv
+from framecontext import MaskContext
+
+# Reduced-resolution mask computation. The frame is downscaled by 'scale', blur, CLAHE, the HSV
+# threshold and the mask cleanup run on the small frame with the object/hole areas and the kernel
+# sizes scaled to match, and the mask is upsampled back to the frame size. Land/water boundaries
+# are smooth, so only the pixels along the upsampled mask edges are uncertain: those are refined
+# with the HSV threshold of their full-resolution colour, blurred as by the filter. The blur is
+# computed only around the edges, on runs of REFINE_BLOCK pixel blocks containing edge pixels
+# padded by the blur radius, which gives the same colours as blurring the whole frame (the whole
+# frame is blurred when the edges cover most blocks).
+# CLAHE equalizes every frame with histograms of the whole frame and has no such local form, so
+# with CLAHE the edges are not refined.
+# With 'report_iou' the full-resolution mask is computed as well and the IoU of the two masks
+# is recorded for every frame, to show the speed/accuracy tradeoff of the scale.
+REFINE_BLOCK = 64
+
+
+class ScaledMasker(MaskContext):
+
+    def __init__(self, masker, hsv_filter, scale=0.5, report_iou=False):
+        self.masker = masker
+        self.hsv_filter = hsv_filter
+        self.scale = scale
+        self.report_iou = report_iou
+        self.scaled_filter = self.scale_filter(hsv_filter, scale)
+        self.shape = None
+        self.refine = not hsv_filter.clahe
+        self.halo = masker.get_kernel_size(hsv_filter.blur)//2 if hsv_filter.blur > 0 else 0
+
+        self.ious = [] # IoU against the full-resolution mask per frame
+        self.status = ''
+
+    # returns the trackbar position whose kernel size is closest to 'kernel_size', 0 below 2 pixels
+    @staticmethod
+    def get_kernel_position(kernel_size):
+        if kernel_size < 2:
+            return 0
+        return max(1, round((kernel_size-3)/2)+1)
+
+    # returns a copy of the filter with the pixel areas and kernel sizes scaled by 'scale'
+    def scale_filter(self, hsv_filter, scale):
+        scaled_filter = copy.copy(hsv_filter)
+        if hsv_filter.blur > 0:
+            scaled_filter.blur = self.get_kernel_position(self.masker.get_kernel_size(hsv_filter.blur)*scale)
+        if hsv_filter.close > 0:
+            scaled_filter.close = self.get_kernel_position(self.masker.get_kernel_size(hsv_filter.close)*scale)
+        scaled_filter.object = round(hsv_filter.object*scale*scale)
+        scaled_filter.hole = round(hsv_filter.hole*scale*scale)
+        return scaled_filter
+
+    def allocate(self, shape):
+        h, w = shape[:2]
+        self.shape = shape
+        self.small_size = (max(1, round(w*self.scale)), max(1, round(h*self.scale)))
+        self.upsampled = np.empty((h,w), np.uint8)
+        self.mask = np.empty((h,w), np.uint8)
+        self.inverted = np.empty((h,w), np.uint8)
+
+    # edge-aware refinement: decides the pixels along the upsampled mask edges by their
+    # full-resolution colour, preprocessed on the edge blocks only
+    def refine_edges(self, frame, upsampled):
+        h, w = frame.shape[:2]
+        edge = (upsampled > 0) & (upsampled < 255)
+        if not self.halo:
+            self.mask[edge] = self.masker.threshold_frame(frame[edge].reshape(-1, 1, 3), self.hsv_filter).reshape(-1)
+            return
+
+        b = REFINE_BLOCK
+        rows, cols = -(-h//b), -(-w//b)
+        blocks = np.zeros((rows*b, cols*b), bool)
+        blocks[:h, :w] = edge
+        blocks = blocks.reshape(rows, b, cols, b).any(axis=(1, 3))
+        crops = [] # (run, run with the blur halo) as (y0, y1, x0, x1)
+        for row in np.flatnonzero(blocks.any(axis=1)):
+            # runs of consecutive edge blocks in the block row
+            changes = np.flatnonzero(np.diff(np.concatenate(([0], blocks[row].astype(np.int8), [0]))))
+            y0, y1 = row*b, min(h, (row+1)*b)
+            for start, end in zip(changes[::2], changes[1::2]):
+                x0, x1 = start*b, min(w, end*b)
+                # clipped at the frame borders like the full-frame blur
+                crops.append(((y0, y1, x0, x1), (max(0, y0-self.halo), min(h, y1+self.halo),
+                                                 max(0, x0-self.halo), min(w, x1+self.halo))))
+
+        if sum((py1-py0)*(px1-px0) for _, (py0, py1, px0, px1) in crops) > h*w//2:
+            # edges all over the frame, the halos would blur most pixels more than once
+            processed = self.masker.preprocess_frame(frame, self.hsv_filter)
+            self.mask[edge] = self.masker.threshold_frame(processed[edge].reshape(-1, 1, 3), self.hsv_filter).reshape(-1)
+            return
+        for (y0, y1, x0, x1), (py0, py1, px0, px1) in crops:
+            processed = self.masker.preprocess_frame(frame[py0:py1, px0:px1], self.hsv_filter)
+            processed = processed[y0-py0:y1-py0, x0-px0:x1-px0]
+            block_edge = edge[y0:y1, x0:x1]
+            colours = processed[block_edge].reshape(-1, 1, 3)
+            self.mask[y0:y1, x0:x1][block_edge] = self.masker.threshold_frame(colours, self.hsv_filter).reshape(-1)
+
+    # applies the HSV filter at reduced resolution. The processed frame is not upsampled,
+    # the input frame is returned in its place.
+    def create_mask(self, frame):
+        if frame.shape != self.shape:
+            self.allocate(frame.shape)
+        h, w = frame.shape[:2]
+
+        small = cv.resize(frame, self.small_size, interpolation=cv.INTER_AREA)
+        small_mask,_,_ = self.masker.create_mask(small, self.scaled_filter)
+
+        # bilinear upsampling, pixels between 0 and 255 lie along the low-resolution mask edges
+        upsampled = cv.resize(small_mask, (w, h), dst=self.upsampled, interpolation=cv.INTER_LINEAR)
+        cv.threshold(upsampled, 127, 255, cv.THRESH_BINARY, dst=self.mask)
+
+        if self.refine:
+            self.refine_edges(frame, upsampled)
+
+        if self.report_iou:
+            full_mask,_,_ = self.masker.create_mask(frame, self.hsv_filter)
+            union = cv.countNonZero(cv.bitwise_or(full_mask, self.mask))
+            intersection = cv.countNonZero(cv.bitwise_and(full_mask, self.mask))
+            iou = intersection/union if union else 1.0
+            self.ious.append(iou)
+            self.status = f'IoU: {iou:.4f}.'
+
+        return self.mask, frame, self.hsv_filter
+
+    def report(self):
+        if self.ious:
+            print(f'IoU against the full-resolution mask: mean {np.mean(self.ious):.4f}, min {np.min(self.ious):.4f}.')
@@ -0,0 +1,148 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2 as cv
+
+# Segment-parallel masking. The input video is split into contiguous frame ranges,
+# every range is masked by a separate process with its own Masker/VideoCapture/VideoWriter
+# and the partial videos are stitched into the final output.
+
+# lossless codecs tried for the partial videos when ffmpeg is not available to concatenate
+# the partial videos without re-encoding
+INTERMEDIATE_CODECS = [("FFV1", "mkv"), ("HFYU", "avi")]
+
+
+# splits frames 0..length into at most 'segments' contiguous (start, end) ranges
+def split_frame_ranges(length, segments):
+    segments = max(1, min(segments, length))
+    bounds = [round(i*length/segments) for i in range(segments+1)]
+    return [(bounds[i], bounds[i+1]) for i in range(segments) if bounds[i+1] > bounds[i]]
+
+
+# returns the (fourcc, extension) of a lossless codec that OpenCV can write on this system
+def get_intermediate_codec(fps, resolution):
+    for codec, extension in INTERMEDIATE_CODECS:
+        fd, path = tempfile.mkstemp(suffix='.'+extension)
+        os.close(fd)
+        try:
+            fourcc = cv.VideoWriter_fourcc(*codec)
+            writer = cv.VideoWriter(path, fourcc, fps, resolution)
+            opened = writer.isOpened()
+            writer.release()
+        finally:
+            os.remove(path)
+        if opened:
+            return fourcc, extension
+    return None
+
+
+# worker process: masks frames start..end of the video into 'output', returns the number of masked frames
+def mask_segment(video_path, hsv_filter, start, end, output, fourcc, compiled=False, context_options=None, region=None):
+    from masker import Masker
+    from compiledfilter import CompiledHSVfilter
+
+    video = Masker(video_path)
+    if region:
+        # 'start' and 'end' count the frames selected by the region options
+        video.set_region(**region)
+    if compiled:
+        # loads the lookup table compiled by the parent process from the cache
+        video.compiled_filter = CompiledHSVfilter(video, hsv_filter)
+    video.capture.set(cv.CAP_PROP_POS_FRAMES, start)
+    position = int(video.capture.get(cv.CAP_PROP_POS_FRAMES))
+    if position != start:
+        print(f'\nWARNING: seeking to frame {start} landed on frame {position}.')
+
+    masked_video = video.wrap_writer(cv.VideoWriter(output, fourcc, video.fps, video.resolution))
+    context = video.create_context(hsv_filter, **(context_options if context_options else {}))
+    nframe = video.mask_frames(hsv_filter, masked_video, max_frames=end-start, progress=False, context=context)
+    if hasattr(context, 'close'):
+        context.close()
+
+    video.capture.release()
+    masked_video.release()
+    return nframe
+
+
+# joins the partial videos into 'output'. Uses ffmpeg stream copy when available, otherwise
+# decodes the partial videos and encodes them once into 'output'. Returns the number of frames joined.
+def concatenate_videos(parts, output, fourcc, fps, resolution):
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg:
+        list_file = os.path.join(os.path.dirname(parts[0]), 'segments.txt')
+        with open(list_file, 'w') as f:
+            for part in parts:
+                f.write("file '{}'\n".format(part.replace("'", "'\\''")))
+        subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                        '-i', list_file, '-c', 'copy', output], check=True)
+        capture = cv.VideoCapture(output)
+        nframe = int(capture.get(cv.CAP_PROP_FRAME_COUNT))
+        capture.release()
+        return nframe
+
+    masked_video = cv.VideoWriter(output, fourcc, fps, resolution)
+    nframe = 0
+    for part in parts:
+        capture = cv.VideoCapture(part)
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            masked_video.write(frame)
+            nframe += 1
+        capture.release()
+    masked_video.release()
+    return nframe
+
+
+# returns the (fourcc, extension) of the partial videos joined into 'output' by concatenate_videos.
+# Partial videos are written with the output codec when ffmpeg can join them by stream copy,
+# otherwise with a lossless codec so that the final video is encoded only once.
+def get_part_format(masker, output, fourcc):
+    if shutil.which('ffmpeg'):
+        return fourcc, os.path.splitext(output)[1]
+    intermediate = get_intermediate_codec(masker.fps, masker.resolution)
+    if intermediate:
+        return intermediate[0], '.'+intermediate[1]
+    print('WARNING: ffmpeg and lossless codecs are unavailable, segments will be encoded twice.')
+    return fourcc, os.path.splitext(output)[1]
+
+
+# masks the video of 'masker' with 'segments' processes and writes the result to 'output'.
+# Returns the number of frames in the stitched output.
+def mask_segments(masker, hsv_filter, output, fourcc, segments, compiled=False, context_options=None, region=None):
+    ranges = split_frame_ranges(masker.length, segments)
+
+    part_fourcc, extension = get_part_format(masker, output, fourcc)
+
+    temp_dir = tempfile.mkdtemp(prefix='.'+masker.name+'_segments_', dir=os.path.dirname(output))
+    parts = [os.path.join(temp_dir, f'segment_{i:04d}{extension}') for i in range(len(ranges))]
+
+    try:
+        with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = {executor.submit(mask_segment, masker.video_path, hsv_filter, start, end, part, part_fourcc, compiled, context_options, region): i
+                       for i, ((start, end), part) in enumerate(zip(ranges, parts))}
+
+            counts = [0]*len(ranges)
+            for future in as_completed(futures):
+                i = futures[future]
+                counts[i] = future.result()
+                start, end = ranges[i]
+                print(f'Masked segment {i+1}/{len(ranges)} (frames {start} to {end-1}).')
+
+        # every segment must contain exactly the frames of its range
+        for (start, end), count in zip(ranges, counts):
+            if count != end-start:
+                print(f'WARNING: segment starting at frame {start} masked {count} frames instead of {end-start}.')
+
+        print('Joining masked segments...')
+        nframe = concatenate_videos(parts, output, fourcc, masker.fps, masker.resolution)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if nframe != sum(counts):
+        print(f'WARNING: joined video has {nframe} frames, segments contained {sum(counts)} frames.')
+
+    return nframe
@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Stage-level memoization of Masker.create_mask for GUI mode. create_mask is evaluated as a chain
+# of stages, each depending only on the output of the previous stage and on its own parameters:
+#
+#   preprocess  blur, clahe                       (frame -> processed frame)
+#   hsv         sAdd, sSub, vAdd                  (processed frame -> adjusted HSV frame)
+#   threshold   h/s/v min/max, ranges             (HSV frame -> threshold mask)
+#   filter      engine, object, hole              (threshold mask -> filtered mask)
+#   close       close                             (filtered mask -> mask)
+#
+# (the V channel is shifted with sSub, as in Masker.threshold_hsv, so vSub has no effect.)
+# The result of every stage is cached under the frame key and the parameters of the stage and of
+# all stages before it, so moving a trackbar only recomputes its stage and the stages after it.
+# Cached arrays are shared: callers must not modify the returned mask or frame. The cache is
+# bounded to 'max_bytes' of arrays, evicting the least recently used results first.
+STAGES = [
+    ('preprocess', ['blur', 'clahe']),
+    ('hsv', ['sAdd', 'sSub', 'vAdd']),
+    ('threshold', ['hMin', 'sMin', 'vMin', 'hMax', 'sMax', 'vMax', 'ranges']),
+    ('filter', ['engine', 'object', 'hole']),
+    ('close', ['close']),
+]
+
+
+class StageCache:
+
+    def __init__(self, masker, max_bytes=512*1024*1024):
+        self.masker = masker
+        self.max_bytes = max_bytes
+        self.results = OrderedDict() # stage key -> result, least recently used first
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # returns the cache keys of every stage for the frame and filter
+    @staticmethod
+    def get_keys(frame_key, hsv_filter):
+        keys = []
+        key = (frame_key,)
+        for stage, parameters in STAGES:
+            key = key + (stage,) + tuple(repr(getattr(hsv_filter, p)) for p in parameters)
+            keys.append(key)
+        return keys
+
+    def get(self, key):
+        with self.lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        with self.lock:
+            if key in self.results:
+                return
+            self.results[key] = result
+            self.nbytes += result.nbytes
+            while self.nbytes > self.max_bytes and len(self.results) > 1:
+                _, evicted = self.results.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def compute(self, stage, value, hsv_filter):
+        masker = self.masker
+        if stage == 'preprocess':
+            return masker.preprocess_frame(value, hsv_filter)
+        if stage == 'hsv':
+            return masker.convert_hsv(value, hsv_filter)
+        if stage == 'threshold':
+            return masker.threshold_ranges(value, hsv_filter)
+        if stage == 'filter':
+            # the filters draw into their input, the cached threshold mask is copied
+            if hsv_filter.engine == 'components':
+                return masker.apply_component_filter(value.copy(), hsv_filter.object, hsv_filter.hole)
+            return masker.apply_contour_filter(value.copy(), hsv_filter.object, hsv_filter.hole)
+        if hsv_filter.close > 0:
+            return masker.apply_close(value, masker.get_kernel_size(hsv_filter.close))
+        return value
+
+    # same as Masker.create_mask, reusing the cached stages of the frame identified by 'frame_key'
+    def create_mask(self, frame_key, frame, hsv_filter):
+        keys = self.get_keys(frame_key, hsv_filter)
+
+        # latest stage with a cached result
+        start, value = 0, frame
+        for i in range(len(STAGES)-1, -1, -1):
+            result = self.get(keys[i])
+            if result is not None:
+                start, value = i+1, result
+                break
+        self.hits += start
+        self.misses += len(STAGES)-start
+
+        processed = self.get(keys[0]) if start > 0 else None
+        for i in range(start, len(STAGES)):
+            value = self.compute(STAGES[i][0], value, hsv_filter)
+            self.put(keys[i], value)
+            if i == 0:
+                processed = value
+        if processed is None:
+            # evicted between the lookups, recomputed for display
+            processed = self.masker.preprocess_frame(frame, hsv_filter)
+
+        return value, processed, hsv_filter
+
+
+# Runs StageCache.create_mask on a background thread, so the GUI loop keeps showing frames and
+# reading the trackbars while a large frame is masked. Only the latest request is computed.
+# A request with new filter parameters waits until the parameters have not changed for
+# 'debounce' seconds, so dragging a trackbar does not queue a recomputation for every position.
+class BackgroundMasker:
+
+    def __init__(self, stage_cache, debounce=0.05):
+        self.stage_cache = stage_cache
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        self.request = None # (frame key, frame, filter, parameters, time ready)
+        self.submitted = None # (frame key, parameters) of the latest request
+        self.result = None # (frame key, frame, mask, processed frame) of the latest computed request
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # requests the mask of a frame. Repeated requests for the computed frame and filter are ignored.
+    def submit(self, frame_key, frame, hsv_filter):
+        parameters = hsv_filter.to_dict()
+        if self.submitted == (frame_key, parameters):
+            return
+        with self.condition:
+            debounced = self.submitted is not None and self.submitted[1] != parameters
+            ready = time.perf_counter() + (self.debounce if debounced else 0)
+            self.request = (frame_key, frame, hsv_filter, ready)
+            self.submitted = (frame_key, parameters)
+            self.condition.notify()
+
+    # returns (frame key, frame, mask, processed frame) of the latest computed request, None before the first
+    def get_result(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    while self.request is None and not self.stopped:
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+                    # wait until the request is ready, a newer request replaces it
+                    while self.request is not None and time.perf_counter() < self.request[3]:
+                        self.condition.wait(self.request[3]-time.perf_counter())
+                    if self.request is None or self.stopped:
+                        continue
+                    frame_key, frame, hsv_filter, _ = self.request
+                    self.request = None
+
+                mask, processed, _ = self.stage_cache.create_mask(frame_key, frame, hsv_filter)
+                self.result = (frame_key, frame, mask, processed)
+        except Exception as e:
+            self.error = e
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,62 @@
+import numpy as np
+import cv2 as cv
+from masker import Masker
+from compiledfilter import CompiledHSVfilter
+
+# Streaming masking API. Frames come from any iterable of BGR frames, a cv.VideoCapture or a
+# stream of raw BGR bytes (e.g. the stdout of an ffmpeg decoder), and masks are produced frame by
+# frame without intermediate files.
+
+
+# yields the frames of a cv.VideoCapture until it ends
+def iter_capture(capture):
+    while capture.isOpened():
+        ret, frame = capture.read()
+        if not ret:
+            break
+        yield frame
+
+
+# yields (height, width, 3) BGR frames read from a binary stream of raw bgr24 frames. A partial
+# frame at the end of the stream raises an EOFError.
+def iter_raw_frames(stream, width, height):
+    frame_size = width*height*3
+    while True:
+        frame = np.empty((height, width, 3), np.uint8)
+        buffer = memoryview(frame).cast('B')
+        read = 0
+        while read < frame_size:
+            n = stream.readinto(buffer[read:])
+            if not n:
+                break
+            read += n
+        if read == 0:
+            return
+        if read < frame_size:
+            raise EOFError(f'Stream ended within a frame ({read} of {frame_size} bytes).')
+        yield frame
+
+
+# yields (frame, mask) for every frame of 'source', a cv.VideoCapture or an iterable of BGR frames.
+# 'compiled' and the options of Masker.create_context ('context_options') are the same as for
+# Masker.mask_and_export. With a context the mask belongs to the context and is overwritten by the
+# next frame: copy it to keep it.
+def iter_masks(source, hsv_filter, compiled=False, context_options=None):
+    masker = Masker()
+    if compiled:
+        # threshold frames through a precomputed BGR->mask lookup table
+        masker.compiled_filter = CompiledHSVfilter(masker, hsv_filter)
+    context = masker.create_context(hsv_filter, **(context_options if context_options else {}))
+
+    frames = iter_capture(source) if isinstance(source, cv.VideoCapture) else source
+    try:
+        for frame in frames:
+            if context:
+                mask,_,_ = context.create_mask(frame) # compute mask
+            else:
+                mask,_,_ = masker.create_mask(frame, hsv_filter) # compute mask
+            yield frame, mask
+    finally:
+        # also run when the caller stops iterating early
+        if hasattr(context, 'close'):
+            context.close()
@@ -0,0 +1,89 @@
+import click
+import cv2 as cv
+from masker import Masker
+from hsvfilter import HSVfilter
+from hsvhistogram import BOX_PARAMETERS, HSVHistogram, labels_iou, load_histogram, search_coverage, search_labels
+
+def parse_labels(ctx, param, value):
+    labels = []
+    for label in value:
+        frame, _, path = label.partition(':')
+        try:
+            labels.append((int(frame), path))
+        except ValueError:
+            raise click.BadParameter(f"expected FRAME:MASK, e.g. 120:mask_120.png, got '{label}'")
+        if not path:
+            raise click.BadParameter(f"missing mask image path in '{label}'")
+    return labels
+
+@click.command()
+@click.option('-i', 'inputfile', type=click.Path(exists=True,resolve_path=True), required=True,
+              help='Video file path.')
+@click.option('-hsv', 'hsvparams', type=click.Path(resolve_path=True), default=None, required=False,
+              help='JSON file path with the HSV filter parameters to start from. Blur, CLAHE and the S/V adjustments are kept, the thresholds are searched.')
+@click.option('-o', 'outputfolder', type=click.Path(resolve_path=True), default=None, required=False,
+              help='Specify folder to save the proposed HSV parameters. Defaults to the folder of the video.')
+@click.option('--name', 'filename', type=str, default='hsv_parameters_from_search.json',
+              help='File name of the proposed HSV parameters.')
+@click.option('--frames', 'nframes', type=click.IntRange(min=1), default=50,
+              help='Number of frames sampled evenly over the video for the HSV histogram.')
+@click.option('--coverage', 'target', type=click.FloatRange(min=0, max=1), default=None,
+              help='Target fraction of masked pixels. The threshold set by --vary is searched to match it.')
+@click.option('--vary', 'parameter', type=click.Choice(BOX_PARAMETERS), default='sMin',
+              help='Threshold searched for --coverage, the other thresholds are kept.')
+@click.option('--label', 'labels', type=str, multiple=True, callback=parse_labels,
+              help='Labelled frame as FRAME:MASK, a frame number and a mask image whose non-zero pixels should be masked. Repeat for several frames. The thresholds are fitted to the labels.')
+
+# proposes HSV thresholds from a cumulative HSV histogram of the video, without masking any frame:
+# reports the coverage of the starting filter, or searches thresholds matching a target coverage
+# (--coverage) or labelled frames (--label)
+def ThresholdSearch(inputfile, hsvparams, outputfolder, filename, nframes, target, parameter, labels):
+    hsv_filter = HSVfilter()
+    if hsvparams:
+        hsv_filter.import_from_file(hsvparams)
+    if target is not None and labels:
+        print('ERROR: --coverage and --label cannot be combined. Exiting...')
+        return
+
+    video = Masker(inputfile)
+    outputfolder = outputfolder if outputfolder else video.parent_dir
+
+    if labels:
+        frames, masks = [], []
+        for nframe, path in labels:
+            video.capture.set(cv.CAP_PROP_POS_FRAMES, nframe)
+            ret, frame = video.capture.read()
+            mask = cv.imread(path, cv.IMREAD_GRAYSCALE)
+            if not ret:
+                print(f'ERROR: Could not read frame {nframe} of the video. Exiting...')
+                return
+            if mask is None or mask.shape != frame.shape[:2]:
+                print(f'ERROR: {path} is not a {video.w}x{video.h} mask image. Exiting...')
+                return
+            frames.append(frame)
+            masks.append(mask)
+
+        positives = HSVHistogram.from_frames(video, frames, hsv_filter, masks)
+        totals = HSVHistogram.from_frames(video, frames, hsv_filter)
+        print(f'Labelled pixels: {positives.total/totals.total*100:.2f}% of {len(frames)} frames.')
+        print(f'IoU of the starting thresholds: {float(labels_iou(positives, totals, hsv_filter)):.4f}')
+        hsv_filter, iou = search_labels(positives, totals, hsv_filter)
+        print(f'IoU of the proposed thresholds: {iou:.4f}')
+    else:
+        histogram = load_histogram(video, hsv_filter, nframes)
+        print(f'Coverage of the starting thresholds: {histogram.coverage(hsv_filter)*100:.2f}%')
+        if target is None:
+            video.capture.release()
+            return
+        value, coverage = search_coverage(histogram, hsv_filter, target, parameter)
+        setattr(hsv_filter, parameter, value)
+        print(f'{parameter} = {value}: coverage {coverage*100:.2f}% (target {target*100:.2f}%)')
+
+    print('Proposed thresholds: ' + ', '.join(f'{p}={getattr(hsv_filter, p)}' for p in BOX_PARAMETERS))
+    hsv_filter.save_to_file(outputfolder, filename)
+    print(f'HSV parameters saved to {outputfolder}/{filename}')
+    video.capture.release()
+
+if __name__ == "__main__":
+
+    ThresholdSearch()
@@ -0,0 +1,105 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2 as cv
+from framecontext import MaskContext
+
+# Tiled execution of create_mask for very large frames. Each frame is split into tiles that are
+# processed on a thread pool:
+#   1. blur, CLAHE and the HSV threshold run per tile, on the tile plus a halo of half the blur
+#      kernel, and the tile centres are stitched into a single-channel mask
+#   2. the object/hole filter runs on the stitched mask, so components crossing tile borders are
+#      measured as a whole
+#   3. the close operator runs per tile, on the tile plus a halo of the close kernel size
+# Only the 3-channel arrays of steps 1 and 3 (blurred, equalized and HSV crops) scale with the tile
+# size. The stitched, closed and inverted masks are full-frame single-channel buffers (3 bytes per
+# frame pixel, allocated once), and the object/hole filter of step 2 allocates full-frame
+# temporaries on every frame: about 2 bytes per pixel with the contour engine and 10 bytes per pixel
+# (int32 labels and the relabelled mask) with the component engine, against 12 and 14 bytes per
+# pixel without tiles.
+# Results are identical to create_mask, except with CLAHE: CLAHE is applied per tile with a tile
+# grid scaled to keep the frame's 8x8 cell size, so its histograms differ slightly.
+# The thread pool is shut down by close().
+class TiledMasker(MaskContext):
+
+    def __init__(self, masker, hsv_filter, tile_size=1024, threads=None):
+        self.masker = masker
+        self.hsv_filter = hsv_filter
+        self.tile_size = tile_size
+        self.executor = ThreadPoolExecutor(max_workers=threads if threads else os.cpu_count())
+        self.shape = None
+
+        self.blur_kernel_size = masker.get_kernel_size(hsv_filter.blur) if hsv_filter.blur > 0 else None
+        self.close_kernel_size = masker.get_kernel_size(hsv_filter.close) if hsv_filter.close > 0 else None
+        self.blur_halo = self.blur_kernel_size//2 if self.blur_kernel_size else 0
+        # dilation followed by erosion needs valid pixels up to twice the kernel radius away
+        self.close_halo = self.close_kernel_size-1 if self.close_kernel_size else 0
+
+    # (re)allocates the stitched masks and the tile layout when the resolution changes
+    def allocate(self, shape):
+        h, w = shape[:2]
+        self.shape = shape
+        self.mask = np.empty((h,w), np.uint8)
+        self.closed = np.empty((h,w), np.uint8) if self.close_kernel_size else None
+        self.inverted = np.empty((h,w), np.uint8)
+        t = self.tile_size
+        self.tiles = [(y, min(y+t,h), x, min(x+t,w)) for y in range(0,h,t) for x in range(0,w,t)]
+
+    # returns the tile extended by 'halo' pixels, clipped to the frame
+    def get_halo(self, tile, halo):
+        y0, y1, x0, x1 = tile
+        h, w = self.shape[:2]
+        return max(0,y0-halo), min(h,y1+halo), max(0,x0-halo), min(w,x1+halo)
+
+    def preprocess_tile(self, crop):
+        if self.blur_kernel_size:
+            # Apply Gaussian blur
+            k = self.blur_kernel_size
+            crop = cv.GaussianBlur(crop, (k,k), 0)
+
+        if self.hsv_filter.clahe:
+            # Apply CLAHE with the cell size of an 8x8 grid over the whole frame
+            h, w = self.shape[:2]
+            grid = (max(1, round(8*crop.shape[1]/w)), max(1, round(8*crop.shape[0]/h)))
+            clahe = cv.createCLAHE(clipLimit=2.0, tileGridSize=grid)
+            crop = cv.merge([clahe.apply(c) for c in cv.split(crop)])
+
+        return crop
+
+    def threshold_tile(self, frame, tile):
+        y0, y1, x0, x1 = tile
+        cy0, cy1, cx0, cx1 = self.get_halo(tile, self.blur_halo)
+        crop = self.preprocess_tile(frame[cy0:cy1, cx0:cx1])
+        mask = self.masker.threshold_frame(crop, self.hsv_filter)
+        self.mask[y0:y1, x0:x1] = mask[y0-cy0:y1-cy0, x0-cx0:x1-cx0]
+
+    def close_tile(self, mask, tile):
+        y0, y1, x0, x1 = tile
+        cy0, cy1, cx0, cx1 = self.get_halo(tile, self.close_halo)
+        closed = self.masker.apply_close(mask[cy0:cy1, cx0:cx1], self.close_kernel_size)
+        self.closed[y0:y1, x0:x1] = closed[y0-cy0:y1-cy0, x0-cx0:x1-cx0]
+
+    # applies the HSV filter to the frame tile by tile. The processed frame is not stitched,
+    # the input frame is returned in its place.
+    def create_mask(self, frame):
+        if frame.shape != self.shape:
+            self.allocate(frame.shape)
+        hsv_filter = self.hsv_filter
+
+        # list() waits for all tiles and re-raises the exceptions of the worker threads
+        list(self.executor.map(lambda tile: self.threshold_tile(frame, tile), self.tiles))
+
+        if hsv_filter.engine == 'components':
+            mask = self.masker.apply_component_filter(self.mask, hsv_filter.object, hsv_filter.hole)
+        else:
+            mask = self.masker.apply_contour_filter(self.mask, hsv_filter.object, hsv_filter.hole)
+
+        if self.close_kernel_size:
+            list(self.executor.map(lambda tile: self.close_tile(mask, tile), self.tiles))
+            mask = self.closed
+
+        return mask, frame, hsv_filter
+
+    # stops the worker threads, the context cannot be used afterwards
+    def close(self):
+        self.executor.shutdown()